@@ -1,15 +1,19 @@
+import logging
 import os
+import tempfile
 from flask import Flask
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
+from routing import RoutingSQLAlchemy
 #from decorators import *
 #from models import *
 
 
 
+logger = logging.getLogger(__name__)
+
 # Globally accessible libraries
 login_manager = LoginManager()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 def create_app(test_config=None):
@@ -21,6 +25,10 @@ def create_app(test_config=None):
     deployment to a web server.  Conifgs are in config.py under the instance folder.
     """
 
+    # Times each phase of startup, see warmup.py.
+    from warmup import StartupTimer
+    timer = StartupTimer()
+
     # Initialize the core application.
     app = Flask(__name__)
 
@@ -30,12 +38,68 @@ def create_app(test_config=None):
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', None)
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('SQLALCHEMY_DATABASE_URI', None)
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = os.environ.get('SQLALCHEMY_TRACK_MODIFICATIONS', None)
+
+    # Optional read replica for the read-only views, and how long after a
+    # panelist's last write they keep reading from the primary.
+    app.config['SQLALCHEMY_REPLICA_URI'] = os.environ.get('SQLALCHEMY_REPLICA_URI', None)
+    app.config['REPLICA_STALENESS_SECONDS'] = float(os.environ.get('REPLICA_STALENESS_SECONDS', 10))
+
+    # Identity cache used by the user_loader.  IDENTITY_IN_SESSION also keeps
+    # the panelist's identity in the signed session cookie.
+    app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 1024))
+    app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 30))
+    app.config['IDENTITY_IN_SESSION'] = os.environ.get('IDENTITY_IN_SESSION', '') == '1'
+
+    # How long a panelist holds one of a survey's slots after opening it.
+    app.config['QUOTA_LEASE_MINUTES'] = int(os.environ.get('QUOTA_LEASE_MINUTES', 20))
+
+    # Where finished Excel exports are cached, and how many processes each
+    # worker uses to build them.
+    app.config['EXPORT_CACHE_DIR'] = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'amplify_exports'))
+    app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', 2))
+
+    # Where the columnar response snapshots used by crosstabs are kept, and
+    # how old a snapshot can get before a crosstab of a survey with new
+    # completes rebuilds it.
+    app.config['SNAPSHOT_DIR'] = os.environ.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'amplify_snapshots'))
+    app.config['SNAPSHOT_REFRESH_SECONDS'] = int(os.environ.get('SNAPSHOT_REFRESH_SECONDS', 300))
+
+    # Requests slower than this many ms are logged with their slowest SQL.
+    # ADMIN_EMAILS is a comma separated list of the panelists who can see
+    # /admin/metrics.
+    app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500))
+    app.config['ADMIN_EMAILS'] = [email.strip() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()]
+
+    # WARM_START=1 does the work of a worker's first requests in create_app,
+    # for gunicorn --preload.  JINJA_CACHE_DIR is where it keeps the compiled
+    # templates.
+    app.config['WARM_START'] = os.environ.get('WARM_START', '') == '1'
+    app.config['JINJA_CACHE_DIR'] = os.environ.get('JINJA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'amplify_jinja'))
+
+    # Where devops.build_assets puts the hashed static assets, see assets.py.
+    app.config['ASSETS_DIST_DIR'] = os.environ.get('ASSETS_DIST_DIR', os.path.join(app.static_folder, 'dist'))
+
+    # Overrides for tests and tools like benchmark.py, eg. another DB URI.
+    if test_config is not None:
+        app.config.update(test_config)
+
+    if app.config['SQLALCHEMY_REPLICA_URI']:
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            app.config.get('SQLALCHEMY_BINDS') or {}, replica=app.config['SQLALCHEMY_REPLICA_URI'])
+
+    # Levelled logging instead of prints.  Does nothing if gunicorn or
+    # something else has already configured logging.
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO'))
+    timer.mark('config')
     
     # Imports
     import models
     from models import Panelist
     import decorators
     import forms
+    import identity
+    identity.identity_cache.configure(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+    timer.mark('imports')
 
 
     # Define a user_loader callback for the LoginManager instance.
@@ -44,17 +108,13 @@ def create_app(test_config=None):
         """Intakes a unicode user_id and returns a User object for the panelist
         with that id.
 
-        This converts the unicode back to an integer, queries the Panelists table
-        for the panelist with that panelist_id, and returns a User object created
-        from that panelist's data.
+        This converts the unicode back to an integer and gets that panelist
+        from the identity cache, only querying the Panelists table on a miss.
         """
         try:
-            #print(unicode_user_id)
-            #print('Unicode id for the user loader is ' + str(unicode_user_id))
-            return Panelist.query.get(int(unicode_user_id))
-            #return Panelist.query.get(1)
+            return identity.load_panelist(int(unicode_user_id))
         except:
-            #print('Unable to load a user from Panelists with the given unicode ID.')
+            logger.exception('Unable to load a user from Panelists with the given unicode ID.')
             return None
 
 
@@ -62,6 +122,15 @@ def create_app(test_config=None):
     login_manager.init_app(app)
     db.init_app(app)
 
+    # Per-request SQL and latency metrics.
+    import instrumentation
+    instrumentation.init_app(app)
+
+    # Hashed static asset URLs for the templates.
+    import assets
+    assets.init_app(app)
+    timer.mark('plugins')
+
     # Register Blueprints
     import auth
     app.register_blueprint(auth.bp)
@@ -80,7 +149,14 @@ def create_app(test_config=None):
     
     import admin
     app.register_blueprint(admin.bp)
+    timer.mark('blueprints')
+
+    if app.config['WARM_START']:
+        import warmup
+        warmup.warm(app, timer)
 
+    timer.report()
+    instrumentation.request_metrics.record_startup(timer.phases)
 
     return app
 
@@ -0,0 +1,151 @@
+"""Fingerprinted, precompressed static assets.
+
+devops.build_assets() copies every file under static/ into static/dist/
+with a hash of its content in its name (images/clock3.png becomes
+images/clock3.1a2b3c4d5e6f.png), writes a gzipped copy next to each text
+asset that compresses, and records logical name -> hashed name in
+static/dist/manifest.json.  References between assets, like the url()s in
+the CSS, are rewritten to the hashed names.
+
+Templates link to assets with asset_url('images/clock3.png').  Once the
+manifest exists it resolves to /assets/images/clock3.1a2b3c4d5e6f.png,
+which is served with far-future immutable caching since a new version of the
+file gets a new name, and as the .gz copy to browsers that accept gzip.
+Without a manifest (eg. a fresh checkout) it falls back to the plain
+/static/ URL.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+from flask import current_app, request, send_from_directory, url_for
+
+
+# Assets worth gzipping.  Images are already compressed.
+TEXT_EXTENSIONS = ('.css', '.js', '.json', '.svg', '.txt', '.map')
+
+MANIFEST = 'manifest.json'
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# url(...) references in CSS.
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def _hashed_name(name, content):
+    root, extension = posixpath.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha256(content).hexdigest()[:12], extension)
+
+
+def _rewrite_css(name, content, manifest):
+    """Points the url()s of a CSS file at the hashed names of what they
+    reference, keeping them relative."""
+
+    directory = posixpath.dirname(name)
+
+    def rewrite(match):
+        reference = match.group(2)
+        if ':' in reference or reference.startswith(('/', '#')):
+            return match.group(0)
+        path, query = (reference.split('?', 1) + [''])[:2]
+        target = posixpath.normpath(posixpath.join(directory, path))
+        if target not in manifest:
+            return match.group(0)
+        hashed = posixpath.relpath(manifest[target], directory or '.')
+        return "url('%s%s')" % (hashed, '?' + query if query else '')
+
+    return CSS_URL.sub(rewrite, content.decode('utf-8')).encode('utf-8')
+
+
+def build(static_dir, dist_dir):
+    """Builds the hashed and gzipped copies of every asset in static_dir into
+    dist_dir and writes its manifest.  Returns the manifest.
+
+    Files from earlier builds are left in place, so pages rendered by workers
+    still running the old manifest keep working during a deploy.
+    """
+
+    names = []
+    for directory, subdirectories, files in os.walk(static_dir):
+        # Don't build the builds.
+        subdirectories[:] = [subdirectory for subdirectory in subdirectories
+                             if os.path.abspath(os.path.join(directory, subdirectory)) != os.path.abspath(dist_dir)]
+        for file_name in files:
+            path = os.path.relpath(os.path.join(directory, file_name), static_dir)
+            names.append(path.replace(os.sep, '/'))
+
+    # CSS last, so the assets it references already have their hashed names.
+    names.sort(key=lambda name: (name.endswith('.css'), name))
+
+    manifest = {}
+    for name in names:
+        with open(os.path.join(static_dir, name), 'rb') as asset:
+            content = asset.read()
+        if name.endswith('.css'):
+            content = _rewrite_css(name, content, manifest)
+        hashed = manifest[name] = _hashed_name(name, content)
+
+        path = os.path.join(dist_dir, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output:
+            output.write(content)
+        if name.endswith(TEXT_EXTENSIONS):
+            compressed = gzip.compress(content, 9, mtime=0)
+            if len(compressed) < len(content):
+                with open(path + '.gz', 'wb') as output:
+                    output.write(compressed)
+
+    # Replace the manifest in one go, so a worker loading it never sees half.
+    with open(os.path.join(dist_dir, MANIFEST + '.tmp'), 'w') as output:
+        json.dump(manifest, output, indent=1, sort_keys=True)
+    os.replace(os.path.join(dist_dir, MANIFEST + '.tmp'), os.path.join(dist_dir, MANIFEST))
+    return manifest
+
+
+def load_manifest(dist_dir):
+    try:
+        with open(os.path.join(dist_dir, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        return {}
+
+
+def asset_url(name):
+    """The URL of a static asset by its path under static/."""
+
+    hashed = current_app.extensions['assets'].get(name)
+    if hashed is None:
+        return url_for('static', filename=name)
+    return url_for('asset', filename=hashed)
+
+
+def serve_asset(filename):
+    """Serves a built asset, gzipped if the browser accepts it and there is
+    a .gz copy."""
+
+    dist_dir = current_app.config['ASSETS_DIST_DIR']
+    encoding = None
+    if (filename.endswith(TEXT_EXTENSIONS) and request.accept_encodings.quality('gzip') > 0
+            and os.path.isfile(os.path.join(dist_dir, filename + '.gz'))):
+        encoding = 'gzip'
+
+    if encoding is None:
+        response = send_from_directory(dist_dir, filename)
+    else:
+        response = send_from_directory(dist_dir, filename + '.gz', mimetype=mimetypes.guess_type(filename)[0])
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Loads the manifest of ASSETS_DIST_DIR, adds asset_url() to the
+    templates and serves the built assets under /assets/."""
+
+    app.extensions['assets'] = load_manifest(app.config['ASSETS_DIST_DIR'])
+    app.add_url_rule('/assets/<path:filename>', 'asset', serve_asset)
+    app.context_processor(lambda: dict(asset_url=asset_url))
@@ -0,0 +1,402 @@
+"""Synthetic data generator and benchmark suite for the hot paths.
+
+Generate a data set (a SQLite file by default, or any SQLAlchemy URI):
+
+    python benchmark.py generate --size medium --seed 1
+    python benchmark.py generate --uri postgresql://... --panelists 5000 --surveys 400
+
+Time the hot paths against one or more sizes and compare to the baseline:
+
+    python benchmark.py run --sizes small medium
+    python benchmark.py run --sizes small medium --save-baseline
+
+For every case this records the median wall time, the number of SQL
+statements and the peak Python memory of one request.  A case regresses if
+its time grows by more than --tolerance or it runs more queries than the
+baseline; run exits with status 1 when anything regressed.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+from __init__ import db, create_app
+
+
+# Preset volumes: (panelists, surveys).  Each survey gets 5-20 questions and
+# up to its sample size of respondents.
+SIZES = {
+    'small': (200, 40),
+    'medium': (2000, 200),
+    'large': (10000, 800),
+}
+
+BENCHMARK_DIR = os.environ.get('BENCHMARK_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_data'))
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+
+CATEGORIES = ['General Survey', 'Health and Wellness', 'Finance', 'Travel and Lodging', 'Utilities', 'Real Estate', 'Technology', 'TV and Media', 'Food and Beverage', 'Sports and Entertainment', 'Education']
+
+# Rows per executemany while generating.
+INSERT_BATCH_SIZE = 10000
+
+
+def sqlite_uri(size):
+    return 'sqlite:///' + os.path.join(BENCHMARK_DIR, size + '.db')
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+
+def generate_data(uri, num_panelists, num_surveys, seed=0):
+    """Fills the DB at uri with a reproducible synthetic data set.
+
+    Drops and recreates every table, then inserts the reference tables,
+    num_panelists panelists, num_surveys surveys with random targeting and
+    5-20 questions of 2-5 answers each, and responses from random panelists
+    who qualify for each survey.  The same seed always gives the same data.
+    """
+
+    from models import (
+        Panelist, Survey, Question, Answer, Response, SurveyQuota, SurveyCompletion,
+        RACES, GENDERS, REGIONS, mask_of)
+    import devops
+    import tallies
+
+    rng = random.Random(seed)
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        devops.populate_reference_tables()
+        db.session.commit()
+
+        # Hashing is deliberately slow so every panelist shares one hash.
+        password = generate_password_hash('benchmark')
+        today = date.today()
+        panelists = []
+        for panelist_id in range(1, num_panelists + 1):
+            dob = today - timedelta(days=rng.randint(18 * 365, 70 * 365))
+            panelists.append(dict(
+                panelist_id=panelist_id, email='panelist%d@example.com' % panelist_id,
+                password=password, firstname='First%d' % panelist_id, lastname='Last%d' % panelist_id,
+                dob=dob, race_id=rng.randint(1, len(RACES)), gender_id=rng.randint(1, len(GENDERS)),
+                region_id=rng.randint(1, len(REGIONS)), point_balance=0,
+                redeemed_challenge_1=False, redeemed_challenge_2=False))
+        _insert(Panelist.__table__, panelists)
+
+        surveys, questions, answers, responses, completions = [], [], [], [], []
+        question_id = answer_id = response_id = 0
+        for survey_id in range(1, num_surveys + 1):
+            min_age = rng.randint(18, 50)
+            max_age = rng.randint(min_age, 65)
+            race_ids = rng.sample(range(1, len(RACES) + 1), rng.randint(1, len(RACES)))
+            gender_ids = rng.sample(range(1, len(GENDERS) + 1), rng.randint(1, len(GENDERS)))
+            region_ids = rng.sample(range(1, len(REGIONS) + 1), rng.randint(1, len(REGIONS)))
+
+            survey_questions = []
+            for number in range(rng.randint(5, 20)):
+                question_id += 1
+                options = []
+                for option in range(rng.randint(2, 5)):
+                    answer_id += 1
+                    options.append(answer_id)
+                    answers.append(dict(answer_id=answer_id, parent_question_id=question_id, answer='Answer %d' % (option + 1)))
+                questions.append(dict(question_id=question_id, parent_survey_id=survey_id, question='Question %d?' % (number + 1)))
+                survey_questions.append((question_id, options))
+
+            sample_size = rng.randint(10, 500)
+            publisher_id = rng.randint(1, num_panelists)
+            qualifying = [
+                panelist for panelist in panelists
+                if panelist['panelist_id'] != publisher_id
+                and min_age <= today.year - panelist['dob'].year <= max_age
+                and panelist['race_id'] in race_ids
+                and panelist['gender_id'] in gender_ids
+                and panelist['region_id'] in region_ids]
+            respondents = rng.sample(qualifying, min(len(qualifying), rng.randint(0, sample_size)))
+            for panelist in respondents:
+                completions.append(dict(survey_id=survey_id, panelist_id=panelist['panelist_id']))
+                for survey_question_id, options in survey_questions:
+                    response_id += 1
+                    responses.append(dict(
+                        response_id=response_id, parent_survey_id=survey_id,
+                        parent_question_id=survey_question_id,
+                        response_panelist_id=panelist['panelist_id'], answer_id=rng.choice(options),
+                        age_band=tallies.age_band(today.year - panelist['dob'].year), gender_id=panelist['gender_id'],
+                        race_id=panelist['race_id'], region_id=panelist['region_id']))
+
+            surveys.append(dict(
+                survey_id=survey_id, publisher_id=publisher_id, category=rng.choice(CATEGORIES),
+                title='Survey %d' % survey_id, description='Synthetic survey %d' % survey_id,
+                sample_size=sample_size, min_age=min_age, max_age=max_age,
+                race_mask=mask_of(race_ids), gender_mask=mask_of(gender_ids), region_mask=mask_of(region_ids),
+                num_questions=len(survey_questions), point_value=5 * len(survey_questions),
+                status='Completed' if len(respondents) >= sample_size else 'Open',
+                completes=len(respondents)))
+
+        _insert(Survey.__table__, surveys)
+        _insert(SurveyQuota.__table__, [
+            dict(survey_id=survey['survey_id'], slots_available=max(survey['sample_size'] - survey['completes'], 0))
+            for survey in surveys])
+        _insert(Question.__table__, questions)
+        _insert(Answer.__table__, answers)
+        _insert(Response.__table__, responses)
+        _insert(SurveyCompletion.__table__, completions)
+        tallies.rebuild()
+        db.session.commit()
+
+        print('Generated %d panelists, %d surveys, %d questions, %d answers and %d responses.' % (
+            len(panelists), len(surveys), len(questions), len(answers), len(responses)))
+
+
+class QueryCounter(object):
+    """Counts the SQL statements an engine executes."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def measure(call, counter, repeat):
+    """Returns the median wall time in ms, the query count and the peak
+    traced memory in KB of call().  Memory is traced on a separate run since
+    tracing slows everything down."""
+
+    timings = []
+    for _ in range(repeat):
+        counter.count = 0
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    queries = counter.count
+
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'ms': round(statistics.median(timings), 2),
+        'queries': queries,
+        'peak_kb': round(peak / 1024.0, 1),
+    }
+
+
+def login(client, panelist_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(panelist_id)
+        session['_fresh'] = True
+
+
+def _reset_caches():
+    """Empties the in-process caches so each call does its full work."""
+
+    from eligibility import eligibility_index
+    from fragments import home_fragments
+    import identity
+    eligibility_index._loaded_at = None
+    home_fragments.bump_global()
+    identity.identity_cache.clear()
+
+
+def benchmark_size(uri, repeat, warm):
+    """Times every hot path against the DB at uri.  Returns {case: metrics}.
+
+    Requests run outside of any app context of our own: Flask-WTF keeps the
+    CSRF token in g, which would otherwise leak from one client to the next.
+    """
+
+    from models import Panelist, Survey, Response
+    from eligibility import eligibility_index
+
+    import exports
+    import export_jobs
+
+    cache_dir = tempfile.mkdtemp()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'WTF_CSRF_ENABLED': True, 'EXPORT_CACHE_DIR': cache_dir})
+    results = {}
+    with app.app_context():
+        counter = QueryCounter(db.get_engine(app))
+
+        # The panelist used for the read paths, and the survey with the most
+        # responses for results and export.
+        panelist_id = db.session.query(Panelist.panelist_id).order_by(Panelist.panelist_id).first()[0]
+        biggest_survey_id = db.session.query(Response.parent_survey_id).group_by(
+            Response.parent_survey_id).order_by(db.func.count().desc()).first()[0]
+
+        # Each answer POST needs a panelist who hasn't answered the survey
+        # yet, so pair up panelists with one of their eligible surveys.
+        pairs = []
+        for candidate in Panelist.query.order_by(Panelist.panelist_id):
+            eligible = eligibility_index.eligible_survey_ids(candidate)
+            if eligible:
+                pairs.append((candidate.panelist_id, min(eligible)))
+            if len(pairs) == repeat:
+                break
+
+    client = app.test_client()
+    login(client, panelist_id)
+
+    def request(path):
+        def call():
+            if not warm:
+                _reset_caches()
+            response = client.get(path)
+            response.get_data()
+            assert response.status_code == 200, (path, response.status_code)
+        return call
+
+    def eligible_surveys():
+        if not warm:
+            _reset_caches()
+        with app.test_request_context():
+            Panelist.query.get(panelist_id).get_eligible_surveys()
+
+    results['get_eligible_surveys'] = measure(eligible_surveys, counter, repeat)
+    results['home'] = measure(request('/home/'), counter, repeat)
+    for sort in ('recommended', 'shortest', 'longest', 'newest', 'oldest'):
+        results['browse_' + sort] = measure(request('/answer/%s/' % sort), counter, repeat)
+    results['see_results'] = measure(request('/results/%d' % biggest_survey_id), counter, repeat)
+
+    # Building the workbook, which the export pool does in the background,
+    # then downloading it once it is cached.
+    def export_build():
+        with app.app_context():
+            exports.build_survey_export(biggest_survey_id).close()
+
+    results['export_build'] = measure(export_build, counter, repeat)
+    with app.app_context():
+        survey = Survey.query.get(biggest_survey_id)
+        with open(export_jobs.artifact_path(cache_dir, survey.survey_id, survey.completes), 'wb') as output:
+            exports.write_survey_workbook(survey.survey_id, output)
+    results['export_cached'] = measure(request('/export/%d' % biggest_survey_id), counter, repeat)
+    results['admin'] = measure(request('/admin/tables/responses'), counter, repeat)
+
+    def answer_post(candidate_id, survey_id):
+        answering_client = app.test_client()
+        login(answering_client, candidate_id)
+        page = answering_client.get('/answer/%d' % survey_id).get_data(as_text=True)
+        form = dict(re.findall(r'name="(q\d+)"[^>]*value="([^"]*)"', page))
+        form['csrf_token'] = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+        counter.count = 0
+        start = time.perf_counter()
+        response = answering_client.post('/answer/%d' % survey_id, data=form)
+        assert response.status_code == 302, response.status_code
+        return (time.perf_counter() - start) * 1000, counter.count
+
+    # Every POST writes, so each is timed once rather than through measure.
+    if len(pairs) == repeat:
+        timings = [answer_post(*pair) for pair in pairs]
+        results['answer_post'] = {
+            'ms': round(statistics.median(ms for ms, queries in timings), 2),
+            'queries': max(queries for ms, queries in timings),
+            'peak_kb': None,
+        }
+
+    shutil.rmtree(cache_dir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints every case next to its baseline.  Returns the regressions."""
+
+    regressions = []
+    for size, cases in results.items():
+        for case, metrics in cases.items():
+            base = baseline.get(size, {}).get(case)
+            peak_kb = '-' if metrics['peak_kb'] is None else metrics['peak_kb']
+            line = '%-8s %-24s %9.2f ms %6d queries %10s KB' % (
+                size, case, metrics['ms'], metrics['queries'], peak_kb)
+            if base:
+                slower = metrics['ms'] > base['ms'] * (1 + tolerance)
+                more_queries = metrics['queries'] > base['queries']
+                line += '   (baseline %.2f ms, %d queries)' % (base['ms'], base['queries'])
+                if slower or more_queries:
+                    line += '  REGRESSION'
+                    regressions.append((size, case))
+            print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    generate = commands.add_parser('generate', help='fill a DB with synthetic data')
+    generate.add_argument('--size', choices=sorted(SIZES), default='small')
+    generate.add_argument('--uri', help='SQLAlchemy URI, defaults to a SQLite file per size in BENCHMARK_DIR')
+    generate.add_argument('--panelists', type=int, help='overrides the size preset')
+    generate.add_argument('--surveys', type=int, help='overrides the size preset')
+    generate.add_argument('--seed', type=int, default=0)
+
+    run = commands.add_parser('run', help='time the hot paths')
+    run.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=['small'])
+    run.add_argument('--repeat', type=int, default=5)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--warm', action='store_true', help='keep the in-process caches between calls')
+    run.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before a case regresses')
+    run.add_argument('--baseline', default=BASELINE_FILE)
+    run.add_argument('--save-baseline', action='store_true')
+
+    args = parser.parse_args(argv)
+    if not os.path.isdir(BENCHMARK_DIR):
+        os.makedirs(BENCHMARK_DIR)
+
+    if args.command == 'generate':
+        num_panelists, num_surveys = SIZES[args.size]
+        generate_data(
+            args.uri or sqlite_uri(args.size),
+            args.panelists or num_panelists, args.surveys or num_surveys, args.seed)
+        return 0
+
+    if args.command != 'run':
+        parser.print_help()
+        return 1
+
+    results = {}
+    for size in args.sizes:
+        path = os.path.join(BENCHMARK_DIR, size + '.db')
+        if not os.path.exists(path):
+            generate_data(sqlite_uri(size), SIZES[size][0], SIZES[size][1], args.seed)
+        # Benchmark a copy since the answer POSTs write to it.
+        with tempfile.TemporaryDirectory() as scratch:
+            copy = os.path.join(scratch, size + '.db')
+            shutil.copyfile(path, copy)
+            results[size] = benchmark_size('sqlite:///' + copy, args.repeat, args.warm)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print('Baseline saved to ' + args.baseline)
+        return 0
+
+    if regressions:
+        print('%d regressions.' % len(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
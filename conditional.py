@@ -0,0 +1,105 @@
+"""Conditional GETs for pages built from state that is cheap to check.
+
+A view computes an ETag from a few values that change whenever its page
+would, like a survey's completes and num_questions, and returns the 304 of
+not_modified() straight away if the browser already has that version,
+before running the queries and rendering that the page itself needs:
+
+    etag = conditional.page_etag('results', survey.survey_id, survey.completes)
+    if conditional.is_fresh(etag):
+        return conditional.not_modified(etag)
+    ...
+    return conditional.with_etag(render_template(...), etag)
+
+Every page also shows the panelist's name and point balance, so page_etag
+adds those.  Pages with a form add csrf_validators(), which keep a 304 from
+handing out a CSRF token close to expiring.  A request with flashed messages
+waiting is never fresh, since the messages have to be rendered.
+
+The browse pages depend on every survey, so they validate against
+surveys_version(), a counter that the views creating surveys, adding
+questions and closing them bump with bump_surveys_version().  Submissions
+don't bump it, so they never wait on each other for its row: a panelist's
+own submission changes their point balance, which is in every ETag.
+
+The pages are personal, so they are only cached privately and browsers are
+told to revalidate them every time.
+"""
+import hashlib
+import time
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from __init__ import db
+from models import SurveysVersion
+
+
+CACHE_CONTROL = 'private, no-cache'
+
+
+# The id of the one SurveysVersion row.
+SURVEYS_VERSION_ID = 1
+
+
+def surveys_version():
+    """Changes whenever a survey is created, gets a question or closes,
+    which covers everything the browse pages show of them.  A primary key
+    lookup of the SurveysVersion row."""
+
+    return db.session.query(SurveysVersion.version).filter(
+        SurveysVersion.surveys_version_id == SURVEYS_VERSION_ID).scalar()
+
+
+def bump_surveys_version():
+    """Adds 1 to the surveys version.  Call it in the transaction that
+    changes the surveys, so the version can't be seen without the change.
+    Does not commit."""
+
+    bumped = SurveysVersion.query.filter(
+        SurveysVersion.surveys_version_id == SURVEYS_VERSION_ID
+    ).update(
+        {SurveysVersion.version: SurveysVersion.version + 1},
+        synchronize_session=False)
+    if not bumped:
+        # A DB from before devops.create_surveys_version.
+        db.session.add(SurveysVersion(surveys_version_id=SURVEYS_VERSION_ID, version=1))
+
+
+def csrf_validators():
+    """The session's CSRF token and the half of WTF_CSRF_TIME_LIMIT we are
+    in, so a page's token is always less than half the limit old."""
+
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time.time() // (time_limit / 2)) if time_limit else None
+    return (session.get('csrf_token'), period)
+
+
+def page_etag(*validators):
+    """ETag of a page of the current panelist, given the values its content
+    depends on."""
+
+    panelist = (
+        current_user.panelist_id, current_user.firstname, current_user.point_balance,
+        current_user.race_id, current_user.gender_id, current_user.region_id, str(current_user.dob))
+    return hashlib.sha1(repr((panelist, validators)).encode('utf-8')).hexdigest()
+
+
+def is_fresh(etag):
+    """True if the browser already has this version of the page."""
+
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        return False
+    return request.if_none_match.contains_weak(etag)
+
+
+def with_etag(body, etag):
+    """Makes the response of a page and tags it with its ETag."""
+
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag):
+    return with_etag(('', 304), etag)
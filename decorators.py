@@ -1,7 +1,8 @@
 from functools import wraps
-from flask import g, request, redirect, url_for
+from flask import abort, current_app, g, request, redirect, url_for
 from flask_login import current_user
 from models import Panelist
+import routing
 
 # This is used as a decorator function for the views.  A view with 
 # 'login_required' decorator will only get displayed if a user is logged in.
@@ -15,3 +16,27 @@ def login_required(f):
             return f(*args, **kwargs)
     return decorated_function
 
+
+
+# Like 'login_required', but the logged in user's email must also be in the
+# ADMIN_EMAILS config.  Anyone else gets a 403.
+def admin_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user.is_authenticated == False:
+            return redirect(url_for('auth.login', next=request.url))
+        elif current_user.email not in current_app.config['ADMIN_EMAILS']:
+            abort(403)
+        else:
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+# For views that only read.  Their queries go to the read replica, if one is
+# configured and the user hasn't written anything too recently for it.
+def read_only(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        routing.use_replica()
+        return f(*args, **kwargs)
+    return decorated_function
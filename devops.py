@@ -2,31 +2,31 @@ from __init__ import db, create_app
 from models import *
 
 
-def initialize_db():
-    app=create_app()
+def populate_reference_tables():
+    """Adds the Race, Gender, Region and Challenge rows and the
+    SurveysVersion row to the session."""
+    for race in RACES:
+        db.session.add(Race(race=race))
+    print('Races added')
+    for gender in GENDERS:
+        db.session.add(Gender(gender=gender))
+    print('Genders added')
+    for region in REGIONS:
+        db.session.add(Region(region=region))
+    print('Regions added')
+    db.session.add(Challenge(task='Complete a survey', award=20))
+    db.session.add(Challenge(task='Publish a survey', award=20))
+    db.session.add(Challenge(task='Redeem a reward', award=10))
+    print('Challenges added')
+    db.session.add(SurveysVersion(surveys_version_id=1, version=0))
+
+
+def initialize_db(test_config=None):
+    app=create_app(test_config)
     with app.app_context():
         try:
             db.create_all()
-            db.session.add(Race(race='Black or African American'))
-            db.session.add(Race(race='White'))
-            db.session.add(Race(race='Asian'))
-            db.session.add(Race(race='Hispanic or Latino'))
-            db.session.add(Race(race='American Indian or Alaska Native'))
-            db.session.add(Race(race='Native Hawaiian or Other Pacific Islander'))
-            print('Races added')
-            db.session.add(Gender(gender='Male'))
-            db.session.add(Gender(gender='Female'))
-            db.session.add(Gender(gender='Non-binary'))
-            print('Genders added')
-            db.session.add(Region(region='Northeast'))
-            db.session.add(Region(region='Midwest'))
-            db.session.add(Region(region='West'))
-            db.session.add(Region(region='South'))
-            print('Regions added')
-            db.session.add(Challenge(task='Complete a survey', award=20))
-            db.session.add(Challenge(task='Publish a survey', award=20))
-            db.session.add(Challenge(task='Redeem a reward', award=10))
-            print('Challenges added')
+            populate_reference_tables()
             db.session.commit()
             print('All tables initialized and populated with data.')
         except:
@@ -40,5 +40,502 @@ def wipe_db():
     except:
         print('There was an issue dropping all tables.')
 
+def create_ledger():
+    """Adds the points ledger tables to an existing DB.
+
+    Balances earned before the ledger existed are recorded as one
+    'Opening balance' entry per panelist so that the ledger adds up to
+    Panelist.point_balance from the start.
+    """
+    app=create_app()
+    with app.app_context():
+        try:
+            db.create_all()
+            panelists = Panelist.query.filter(
+                Panelist.point_balance != 0,
+                ~Panelist.point_transactions.any()
+                ).all()
+            for panelist in panelists:
+                db.session.add(PointTransaction(
+                    panelist_id=panelist.panelist_id,
+                    amount=panelist.point_balance,
+                    reason='Opening balance'))
+            db.session.commit()
+            print('Ledger created with ' + str(len(panelists)) + ' opening balances.')
+        except:
+            print('There was an error creating the points ledger.')
+
+
+def snapshot_point_balances():
+    """Rolls the ledger into PointSnapshots and checks it against the
+    running balances.  Meant to be run periodically, eg. from a cron job."""
+    import ledger
+    app=create_app()
+    with app.app_context():
+        try:
+            written = ledger.take_snapshots()
+            db.session.commit()
+            print(str(written) + ' snapshots written.')
+            for panelist in Panelist.query:
+                ledger_balance = ledger.balance(panelist.panelist_id)
+                if ledger_balance != (panelist.point_balance or 0):
+                    print('Panelist ' + str(panelist.panelist_id) + ' has a balance of '
+                        + str(panelist.point_balance) + ' but the ledger says ' + str(ledger_balance) + '.')
+        except:
+            print('There was an error snapshotting point balances.')
+
+
+def add_indexes():
+    """Creates any index declared on the models that an existing DB is
+    missing.  db.create_all only creates indexes along with new tables, so
+    this is the migration for DBs created before the indexes were declared."""
+    app=create_app()
+    with app.app_context():
+        try:
+            engine = db.get_engine(app)
+            inspector = db.inspect(engine)
+            existing_tables = inspector.get_table_names()
+            created = 0
+            for table in db.metadata.sorted_tables:
+                if table.name not in existing_tables:
+                    continue
+                existing = set(index['name'] for index in inspector.get_indexes(table.name))
+                for index in table.indexes:
+                    if index.name not in existing:
+                        index.create(bind=engine)
+                        print('Created index ' + index.name)
+                        created += 1
+            print(str(created) + ' indexes created.')
+        except:
+            print('There was an error adding the indexes.')
+
+
+def create_quotas():
+    """Adds the quota tables to an existing DB and gives every survey its
+    quota, with the slots its completes haven't used yet."""
+    app=create_app()
+    with app.app_context():
+        try:
+            db.create_all()
+            surveys = Survey.query.filter(
+                ~Survey.survey_id.in_(db.session.query(SurveyQuota.survey_id))
+                ).all()
+            for survey in surveys:
+                db.session.add(SurveyQuota(
+                    survey_id=survey.survey_id,
+                    slots_available=max(survey.sample_size - (survey.completes or 0), 0)))
+            db.session.commit()
+            print('Quotas created for ' + str(len(surveys)) + ' surveys.')
+        except:
+            print('There was an error creating the survey quotas.')
+
+
+def create_surveys_version():
+    """Adds the SurveysVersion table that the browse pages validate their
+    ETags against to an existing DB, with its one row."""
+    app=create_app()
+    with app.app_context():
+        try:
+            db.create_all()
+            if SurveysVersion.query.get(1) is None:
+                db.session.add(SurveysVersion(surveys_version_id=1, version=0))
+            db.session.commit()
+            print('Surveys version created.')
+        except:
+            print('There was an error creating the surveys version.')
+
+
+def create_completions():
+    """Adds the SurveyCompletion table to an existing DB, with a completion
+    for every panelist who has responses to a survey."""
+    from sqlalchemy import select
+    app=create_app()
+    with app.app_context():
+        try:
+            db.create_all()
+            completions = SurveyCompletion.__table__
+            responses = select([Response.parent_survey_id, Response.response_panelist_id]).where(
+                ~db.session.query(completions).filter(
+                    completions.c.survey_id == Response.parent_survey_id,
+                    completions.c.panelist_id == Response.response_panelist_id).exists()
+                ).distinct()
+            created = db.session.execute(completions.insert().from_select(['survey_id', 'panelist_id'], responses)).rowcount
+            db.session.commit()
+            print(str(created) + ' completions created.')
+        except:
+            print('There was an error creating the survey completions.')
+
+
+def reclaim_expired_leases():
+    """Returns the slots of every expired quota lease.  Opening a full
+    survey already does this for that survey, so this is only to keep the
+    quotas tidy, eg. from a cron job."""
+    import quota
+    app=create_app()
+    with app.app_context():
+        try:
+            returned = quota.reclaim_expired_leases()
+            db.session.commit()
+            print(str(returned) + ' expired leases reclaimed.')
+        except:
+            print('There was an error reclaiming expired leases.')
+
+
+def rebuild_tallies(*survey_ids):
+    """Recounts the result tallies of the given surveys, or of every survey,
+    from their responses.  Also the migration for DBs created before the
+    tallies existed."""
+    import tallies
+    app=create_app()
+    with app.app_context():
+        try:
+            db.create_all()
+            written = tallies.rebuild([int(survey_id) for survey_id in survey_ids] or None)
+            db.session.commit()
+            print(str(written) + ' tally rows written.')
+        except:
+            print('There was an error rebuilding the tallies.')
+
+
+def check_tallies(*survey_ids):
+    """Checks the result tallies of the given surveys, or of every survey,
+    against a recount of their responses.  Returns False on any mismatch."""
+    import tallies
+    app=create_app()
+    with app.app_context():
+        mismatches = tallies.check([int(survey_id) for survey_id in survey_ids] or None)
+        for (answer_id, dimension, bucket), tally, recount in mismatches:
+            print('Answer ' + str(answer_id) + ', ' + dimension + ' ' + str(bucket)
+                + ': tally ' + str(tally) + ' but ' + str(recount) + ' responses.')
+        print(str(len(mismatches)) + ' mismatched tallies.')
+        return not mismatches
+
+
+def encode_demographics():
+    """Migrates a DB from before the integer-coded demographics.
+
+    Adds Panelists.race_id/gender_id/region_id and fills them in from the old
+    race/gender/region names, turns dob into a DATE column (on SQLite, where
+    column types aren't enforced, the ISO date strings already read back as
+    dates) and adds the race/gender/region masks of Surveys, built from the
+    old junction tables.  The old columns and tables are left in place.
+    """
+    app=create_app()
+    with app.app_context():
+        try:
+            engine = db.get_engine(app)
+            inspector = db.inspect(engine)
+            panelist_columns = set(column['name'] for column in inspector.get_columns('panelists'))
+            survey_columns = set(column['name'] for column in inspector.get_columns('surveys'))
+            with engine.begin() as connection:
+                for column, table, name in (('race_id', 'races', 'race'), ('gender_id', 'genders', 'gender'), ('region_id', 'regions', 'region')):
+                    if column in panelist_columns:
+                        continue
+                    connection.execute('ALTER TABLE panelists ADD COLUMN ' + column + ' SMALLINT REFERENCES ' + table + ' (' + column + ')')
+                    if name in panelist_columns:
+                        connection.execute(
+                            'UPDATE panelists SET ' + column + ' = (SELECT ' + table + '.' + column + ' FROM ' + table
+                            + ' WHERE ' + table + '.' + name + ' = panelists.' + name + ')')
+                    print('Added panelists.' + column)
+
+                if engine.dialect.name == 'postgresql':
+                    connection.execute("ALTER TABLE panelists ALTER COLUMN dob TYPE DATE USING NULLIF(dob, '')::date")
+                    print('Converted panelists.dob to a DATE')
+
+                for mask, junction, column in (('race_mask', 'survey_races', 'race_id'), ('gender_mask', 'survey_genders', 'gender_id'), ('region_mask', 'survey_regions', 'region_id')):
+                    if mask in survey_columns:
+                        continue
+                    connection.execute('ALTER TABLE surveys ADD COLUMN ' + mask + ' INTEGER NOT NULL DEFAULT 0')
+                    connection.execute(
+                        'UPDATE surveys SET ' + mask + ' = COALESCE((SELECT SUM(1 << (' + junction + '.' + column + ' - 1)) FROM '
+                        + junction + ' WHERE ' + junction + '.survey_id = surveys.survey_id), 0)')
+                    print('Added surveys.' + mask)
+            print('Demographics encoded.')
+        except:
+            print('There was an error encoding the demographics.')
+
+
+def encode_responses():
+    """Migrates a DB from before responses referenced their answer by id.
+
+    Adds Responses.answer_id and fills it in by matching each response's
+    text with the answers of its question.  If every response matched, drops
+    the old response text column (SQLite 3.35 or later is needed for that)
+    and rebuilds the result tallies, which are now keyed by answer_id.
+    Responses that don't match any answer are listed and the text column is
+    kept, so they can be fixed by hand and this run again.
+    """
+    import tallies
+    app=create_app()
+    with app.app_context():
+        try:
+            engine = db.get_engine(app)
+            inspector = db.inspect(engine)
+            response_columns = set(column['name'] for column in inspector.get_columns('responses'))
+            tally_columns = set(column['name'] for column in inspector.get_columns('response_tallies'))
+            with engine.begin() as connection:
+                if 'answer_id' not in response_columns:
+                    connection.execute('ALTER TABLE responses ADD COLUMN answer_id INTEGER REFERENCES answers (answer_id)')
+                    print('Added responses.answer_id')
+                if 'response' in response_columns:
+                    # The first answer of the question with the same text.
+                    connection.execute(
+                        'UPDATE responses SET answer_id = (SELECT MIN(answers.answer_id) FROM answers'
+                        ' WHERE answers.parent_question_id = responses.parent_question_id'
+                        ' AND answers.answer = responses.response) WHERE answer_id IS NULL')
+                    unmatched = connection.execute(
+                        'SELECT response_id, parent_question_id, response FROM responses WHERE answer_id IS NULL').fetchall()
+                    for response_id, question_id, response in unmatched:
+                        print('Response ' + str(response_id) + ' to question ' + str(question_id)
+                            + ' matches no answer: ' + str(response))
+                    if unmatched:
+                        print(str(len(unmatched)) + ' responses left unmatched, keeping responses.response.')
+                        return
+                    connection.execute('ALTER TABLE responses DROP COLUMN response')
+                    print('Dropped responses.response')
+                    if engine.dialect.name == 'postgresql':
+                        connection.execute('ALTER TABLE responses ALTER COLUMN answer_id SET NOT NULL')
+
+                if 'answer' in tally_columns:
+                    ResponseTally.__table__.drop(connection)
+                    ResponseTally.__table__.create(connection)
+                    print('Recreated response_tallies')
+
+            written = tallies.rebuild()
+            db.session.commit()
+            print(str(written) + ' tally rows written.')
+            print('Responses encoded.')
+        except:
+            print('There was an error encoding the responses.')
+
+
+def record_respondent_demographics():
+    """Migrates a DB from before responses recorded the respondent's
+    demographics.
+
+    Adds Responses.age_band/gender_id/race_id/region_id and fills them in
+    from each panelist's current profile and age, the best there is for
+    responses from before.  The tallies are left as they are, since they
+    were counted with the demographics at the time, so check_tallies can
+    report responses whose panelist has since changed buckets.
+    """
+    import tallies
+    from sqlalchemy import select
+    app=create_app()
+    with app.app_context():
+        try:
+            engine = db.get_engine(app)
+            inspector = db.inspect(engine)
+            response_columns = set(column['name'] for column in inspector.get_columns('responses'))
+            with engine.begin() as connection:
+                if 'age_band' not in response_columns:
+                    connection.execute('ALTER TABLE responses ADD COLUMN age_band VARCHAR(8)')
+                    print('Added responses.age_band')
+                for column, table in (('gender_id', 'genders'), ('race_id', 'races'), ('region_id', 'regions')):
+                    if column not in response_columns:
+                        connection.execute('ALTER TABLE responses ADD COLUMN ' + column + ' SMALLINT REFERENCES ' + table + ' (' + column + ')')
+                        print('Added responses.' + column)
+
+                responses = Response.__table__
+
+                def of_respondent(expression):
+                    return select([expression]).where(
+                        Panelist.panelist_id == responses.c.response_panelist_id).as_scalar()
+
+                filled = connection.execute(responses.update().where(responses.c.age_band.is_(None)).values(
+                    age_band=of_respondent(tallies.age_band_expression()),
+                    gender_id=of_respondent(Panelist.gender_id),
+                    race_id=of_respondent(Panelist.race_id),
+                    region_id=of_respondent(Panelist.region_id))).rowcount
+            print(str(filled) + ' responses filled in.')
+        except:
+            print('There was an error recording the respondent demographics.')
+
+
+def import_surveys(path, publisher_email):
+    """Creates the surveys defined in a JSON file (see survey_import.py) for
+    the panelist with the given email, all at once or not at all."""
+    import json
+    import survey_import
+    app=create_app()
+    with app.test_request_context():
+        publisher = Panelist.query.filter_by(email=publisher_email).first()
+        if publisher is None:
+            print('There is no panelist with the email ' + publisher_email + '.')
+            return
+        with open(path) as definitions:
+            payload = json.load(definitions)
+        try:
+            survey_ids = survey_import.import_surveys(payload, publisher.panelist_id)
+            print('Imported surveys ' + ', '.join(str(survey_id) for survey_id in survey_ids) + '.')
+        except survey_import.SurveyImportError as error:
+            for problem in error.errors:
+                print('Survey ' + str(problem['survey']) + (', question ' + str(problem['question']) if 'question' in problem else '')
+                    + ', ' + str(problem['field']) + ': ' + ' '.join(problem['messages']))
+            print('Nothing was imported.')
+
+
+def replay_to_replica(batch_size=1000):
+    """Copies every table of the primary DB to the replica bind
+    (SQLALCHEMY_REPLICA_URI), replacing what was there.
+
+    For trying out read replica routing locally with two SQLite files, or
+    seeding a replica that isn't kept up to date by the DB itself.
+    """
+    app=create_app()
+    with app.app_context():
+        try:
+            primary = db.get_engine(app)
+            replica = db.get_engine(app, bind='replica')
+            db.metadata.create_all(bind=replica)
+            with primary.connect() as source, replica.begin() as target:
+                for table in reversed(db.metadata.sorted_tables):
+                    target.execute(table.delete())
+                for table in db.metadata.sorted_tables:
+                    rows = source.execution_options(stream_results=True).execute(table.select())
+                    copied = 0
+                    while True:
+                        batch = rows.fetchmany(int(batch_size))
+                        if not batch:
+                            break
+                        target.execute(table.insert(), [dict(row) for row in batch])
+                        copied += len(batch)
+                    print('Copied ' + str(copied) + ' rows of ' + table.name)
+            print('Replica is up to date.')
+        except:
+            print('There was an error replaying the primary to the replica.')
+
+
+def build_assets():
+    """Builds the fingerprinted and gzipped static assets and their manifest
+    into ASSETS_DIST_DIR (static/dist).  Run on every deploy before starting
+    the app."""
+    import assets
+    app=create_app()
+    manifest = assets.build(app.static_folder, app.config['ASSETS_DIST_DIR'])
+    print(str(len(manifest)) + ' assets built.')
+
+
+def build_snapshots(*survey_ids):
+    """Builds the columnar response snapshots used by crosstabs for the
+    given surveys, or for every survey whose snapshot is out of date."""
+    import os
+    import snapshots
+    app=create_app()
+    with app.app_context():
+        try:
+            surveys = Survey.query.order_by(Survey.survey_id)
+            if survey_ids:
+                surveys = surveys.filter(Survey.survey_id.in_([int(survey_id) for survey_id in survey_ids]))
+            built = 0
+            for survey in surveys.all():
+                if not survey_ids and os.path.isdir(snapshots.snapshot_path(
+                        app.config['SNAPSHOT_DIR'], survey.survey_id, survey.completes or 0)):
+                    continue
+                snapshots.build_snapshot(survey.survey_id)
+                built += 1
+            print(str(built) + ' snapshots built.')
+        except:
+            print('There was an error building the snapshots.')
+
+
+# Small reference tables that are fine to scan in full.
+SCANNABLE_TABLES = ('races', 'genders', 'regions', 'challenges')
+
+
+def hot_queries(panelist_id, survey_id):
+    """(name, query) for each query on the hot paths that must use an index:
+    the eligibility index, home, profile, browse, results and export."""
+    import conditional
+    import exports
+    return [
+        ('eligibility: open surveys', db.session.query(
+            Survey.survey_id, Survey.publisher_id, Survey.min_age, Survey.max_age,
+            Survey.race_mask, Survey.gender_mask, Survey.region_mask
+            ).filter(Survey.status == 'Open')),
+        ('eligibility: answered surveys', db.session.query(Response.parent_survey_id).filter(
+            Response.response_panelist_id == panelist_id).distinct()),
+        ('eligibility: answered this survey', db.session.query(Response.response_id).filter(
+            Response.response_panelist_id == panelist_id, Response.parent_survey_id == survey_id)),
+        ('home: responses count', Response.query.filter_by(response_panelist_id=panelist_id)),
+        ('home: published count', Survey.query.filter_by(publisher_id=panelist_id)),
+        ('profile: answered surveys', Survey.query.filter(Survey.survey_id.in_(
+            db.session.query(Response.parent_survey_id).filter(Response.response_panelist_id == panelist_id)))),
+        ('profile: redemptions', Redemption.query.filter_by(redemption_panelist_id=panelist_id)),
+        ('browse: shortest', Survey.query.order_by(Survey.num_questions, Survey.survey_id).limit(13)),
+        ('browse: newest', Survey.query.order_by(Survey.create_date.desc(), Survey.survey_id.desc()).limit(13)),
+        ('browse: version', db.session.query(SurveysVersion.version).filter(
+            SurveysVersion.surveys_version_id == conditional.SURVEYS_VERSION_ID)),
+        ('results: questions', Question.query.filter_by(parent_survey_id=survey_id)),
+        ('results: answers', db.session.query(Question.question_id, Answer.answer_id, Answer.answer).join(
+            Answer, Answer.parent_question_id == Question.question_id
+            ).filter(Question.parent_survey_id == survey_id)),
+        ('results: tallies', db.session.query(
+            ResponseTally.question_id, ResponseTally.answer_id, ResponseTally.dimension,
+            ResponseTally.bucket, ResponseTally.tally
+            ).filter(ResponseTally.survey_id == survey_id, ResponseTally.tally > 0)),
+        ('export: rows', exports.survey_response_rows(survey_id)),
+    ]
+
+
+def full_scans(engine, statement):
+    """Returns the lines of the query plan of statement that scan a whole
+    table other than the SCANNABLE_TABLES."""
+    sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+    if engine.dialect.name == 'sqlite':
+        plan = [row[-1] for row in engine.execute('EXPLAIN QUERY PLAN ' + sql)]
+        scans = [line for line in plan
+            if (line.startswith('SCAN TABLE ') or line.startswith('SCAN '))
+            and 'INDEX' not in line]
+    else:
+        plan = [row[0] for row in engine.execute('EXPLAIN ' + sql)]
+        scans = [line for line in plan if 'Seq Scan' in line]
+    return [line for line in scans
+        if not any(' ' + table in line.replace(' TABLE', '') for table in SCANNABLE_TABLES)]
+
+
+def explain_hot_queries(panelist_id=1, survey_id=1):
+    """Runs EXPLAIN on each hot query and fails if any still scans a whole
+    table.  Run it against a DB with realistic volumes, since Postgres will
+    happily seq scan tables that are small enough.
+
+    Returns True if every query uses an index and False otherwise.
+    """
+    app=create_app()
+    with app.app_context():
+        engine = db.get_engine(app)
+        ok = True
+        for name, query in hot_queries(int(panelist_id), int(survey_id)):
+            scans = full_scans(engine, query.statement)
+            if scans:
+                ok = False
+                print('FULL SCAN in ' + name + ': ' + '; '.join(scans))
+            else:
+                print('ok: ' + name)
+        return ok
+
+
 #initialize_db()
-#wipe_db()
\ No newline at end of file
+#wipe_db()
+#create_ledger()
+#snapshot_point_balances()
+#add_indexes()
+#create_quotas()
+#reclaim_expired_leases()
+#rebuild_tallies()
+#check_tallies()
+#encode_demographics()
+#encode_responses()
+#import_surveys()
+#replay_to_replica()
+#build_assets()
+#build_snapshots()
+#explain_hot_queries()
+
+
+if __name__ == '__main__':
+    # Run one of the commands above, eg. `python devops.py add_indexes`.
+    # Exits with an error status if the command returns False.
+    import sys
+    if globals()[sys.argv[1]](*sys.argv[2:]) is False:
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import defaultdict
+from __init__ import db
+from models import Survey, Response, codes_in
+
+
+class EligibilityIndex(object):
+    """In-process index of the Open surveys, keyed by who they target.
+
+    Panelist.get_eligible_surveys used to run one big query with EXISTS
+    subqueries over the three junction tables and the whole responses table
+    on every home/browse hit.  Instead, each worker keeps the Open surveys in
+    sets keyed by race, gender and region code and every age a survey
+    accepts, so a panelist's eligible surveys are the intersection of four
+    sets minus the ones they published or already answered.
+
+    Usage:
+    eligibility_index.eligible_survey_ids(panelist): set of survey_ids.
+    eligibility_index.is_eligible(panelist, survey_id): True/False.
+    eligibility_index.add_survey(survey): call when a survey is created.
+    eligibility_index.remove_survey(survey_id): call when a survey closes.
+
+    Every gunicorn worker has its own copy, so a survey created or closed in
+    another worker only shows up in the recommended lists once the index is
+    rebuilt.  The index rebuilds itself from the DB every max_age_seconds to
+    bound that.  is_eligible checks the DB for surveys it doesn't have, so a
+    new survey can be answered right away from any worker.
+    """
+
+    def __init__(self, max_age_seconds=60):
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.RLock()
+        self._loaded_at = None
+        self._clear()
+
+    def _clear(self):
+        # survey_id -> (publisher_id, min_age, max_age)
+        self._surveys = {}
+        self._by_race = defaultdict(set)
+        self._by_gender = defaultdict(set)
+        self._by_region = defaultdict(set)
+        self._by_age = defaultdict(set)
+
+    def _index(self, survey_id, publisher_id, min_age, max_age, races, genders, regions):
+        self._surveys[survey_id] = (publisher_id, min_age, max_age)
+        for race in races:
+            self._by_race[race].add(survey_id)
+        for gender in genders:
+            self._by_gender[gender].add(survey_id)
+        for region in regions:
+            self._by_region[region].add(survey_id)
+        # Ages are validated to 18-65 by SurveyDetailsForm so this is at most
+        # 48 entries per survey.
+        for age in range(min_age, max_age + 1):
+            self._by_age[age].add(survey_id)
+
+    def _open_surveys(self):
+        return db.session.query(
+            Survey.survey_id, Survey.publisher_id, Survey.min_age, Survey.max_age,
+            Survey.race_mask, Survey.gender_mask, Survey.region_mask
+        ).filter(Survey.status == 'Open')
+
+    def rebuild(self):
+        """Reload every Open survey and its targeting masks with one flat
+        query."""
+
+        open_surveys = self._open_surveys().all()
+
+        with self._lock:
+            self._clear()
+            for survey_id, publisher_id, min_age, max_age, race_mask, gender_mask, region_mask in open_surveys:
+                self._index(
+                    survey_id, publisher_id, min_age, max_age,
+                    codes_in(race_mask), codes_in(gender_mask), codes_in(region_mask))
+            self._loaded_at = time.time()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.time() - self._loaded_at > self.max_age_seconds:
+            self.rebuild()
+
+    def add_survey(self, survey):
+        """Index a newly created (Open) Survey object."""
+
+        if self._loaded_at is None:
+            # Nothing loaded yet, the first lookup will pick it up.
+            return
+        with self._lock:
+            self._index(
+                survey.survey_id, survey.publisher_id, survey.min_age, survey.max_age,
+                codes_in(survey.race_mask), codes_in(survey.gender_mask), codes_in(survey.region_mask)
+                )
+
+    def remove_survey(self, survey_id):
+        """Drop a survey from the index, eg. once it is Completed."""
+
+        with self._lock:
+            if self._surveys.pop(survey_id, None) is None:
+                return
+            for keyed_sets in (self._by_race, self._by_gender, self._by_region, self._by_age):
+                for survey_ids in keyed_sets.values():
+                    survey_ids.discard(survey_id)
+
+    def answered_survey_ids(self, panelist):
+        """Returns the set of survey_ids a panelist has already responded to."""
+
+        rows = db.session.query(Response.parent_survey_id).filter(
+            Response.response_panelist_id == panelist.panelist_id
+        ).distinct()
+        return set(survey_id for survey_id, in rows)
+
+    def eligible_survey_ids(self, panelist):
+        """Returns the set of survey_ids of Open surveys a panelist qualifies for."""
+
+        self._ensure_loaded()
+        age = panelist.get_age()
+        with self._lock:
+            candidates = (
+                self._by_age.get(age, set())
+                & self._by_race.get(panelist.race_id, set())
+                & self._by_gender.get(panelist.gender_id, set())
+                & self._by_region.get(panelist.region_id, set())
+                )
+            candidates = set(
+                survey_id for survey_id in candidates
+                if self._surveys[survey_id][0] != panelist.panelist_id
+                )
+        if not candidates:
+            return candidates
+        return candidates - self.answered_survey_ids(panelist)
+
+    def is_eligible(self, panelist, survey_id):
+        """Checks a single survey for a panelist with set lookups plus one
+        indexed query for whether they already responded.
+
+        A survey missing from the index may have been created in another
+        worker since the last rebuild, so it is looked up in the DB and
+        indexed if it is Open.
+        """
+
+        self._ensure_loaded()
+        age = panelist.get_age()
+        with self._lock:
+            survey = self._surveys.get(survey_id)
+        if survey is None:
+            row = self._open_surveys().filter(Survey.survey_id == survey_id).first()
+            if row is None:
+                return False
+            survey_id, publisher_id, min_age, max_age, race_mask, gender_mask, region_mask = row
+            with self._lock:
+                self._index(
+                    survey_id, publisher_id, min_age, max_age,
+                    codes_in(race_mask), codes_in(gender_mask), codes_in(region_mask))
+                survey = self._surveys[survey_id]
+        with self._lock:
+            publisher_id, min_age, max_age = survey
+            if (publisher_id == panelist.panelist_id
+                    or not min_age <= age <= max_age
+                    or survey_id not in self._by_race.get(panelist.race_id, ())
+                    or survey_id not in self._by_gender.get(panelist.gender_id, ())
+                    or survey_id not in self._by_region.get(panelist.region_id, ())):
+                return False
+
+        already_answered = db.session.query(Response.response_id).filter(
+            Response.response_panelist_id == panelist.panelist_id,
+            Response.parent_survey_id == survey_id
+        ).first()
+        return already_answered is None
+
+
+# One index per process.  Views import this instance.
+eligibility_index = EligibilityIndex()
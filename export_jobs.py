@@ -0,0 +1,138 @@
+"""Excel exports built in the background and cached on disk.
+
+Building a workbook is CPU bound, so instead of tying up a gunicorn worker
+for the whole build, request_export hands it to a pool of processes and
+returns straight away.  The finished file is kept in EXPORT_CACHE_DIR as
+survey_<survey_id>_<completes>.xlsx, so every download of a survey that
+hasn't had a new complete since is served from disk without touching the
+DB, and a new complete makes the next download build a fresh file.
+
+Each gunicorn worker has its own pool.  Workers coordinate through the
+cache directory: a build writes to <artifact>.partial, which it creates with
+O_EXCL so only one process can build an artifact at a time, and renames it
+into place once it is complete, so a half written file is never served.
+"""
+import glob
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+import exports
+
+
+logger = logging.getLogger(__name__)
+
+# A .partial file that hasn't been written to for this long is left over from
+# a build that died, and is built again.
+STALE_BUILD_SECONDS = 600
+
+_lock = threading.Lock()
+_pool = None
+
+# Artifact path -> Future of the builds this process has started.
+_builds = {}
+
+# The app of a pool process, created by _init_worker.
+_worker_app = None
+
+
+def artifact_path(cache_dir, survey_id, completes):
+    return os.path.join(cache_dir, 'survey_%d_%d.xlsx' % (survey_id, completes))
+
+
+def _init_worker(config):
+    global _worker_app
+    from __init__ import create_app
+    _worker_app = create_app(config)
+
+
+def build_artifact(survey_id, path):
+    """Builds the export of a survey at path.  Runs in a pool process.
+
+    Returns False without doing anything if another process is already
+    building it.  Older exports of the survey are deleted once it's done.
+    """
+
+    partial = path + '.partial'
+    try:
+        fd = os.open(partial, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+
+    try:
+        with os.fdopen(fd, 'wb') as output, _worker_app.app_context():
+            exports.write_survey_workbook(survey_id, output)
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+    for old_path in glob.glob(os.path.join(os.path.dirname(path), 'survey_%d_*.xlsx' % survey_id)):
+        if old_path != path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    return True
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('Building an export failed.', exc_info=future.exception())
+
+
+def _is_building(path):
+    future = _builds.get(path)
+    if future is not None and not future.done():
+        return True
+    try:
+        idle_seconds = time.time() - os.path.getmtime(path + '.partial')
+    except OSError:
+        return False
+    if idle_seconds > STALE_BUILD_SECONDS:
+        os.remove(path + '.partial')
+        return False
+    return True
+
+
+def _submit(survey_id, path):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=current_app.config['EXPORT_WORKERS'],
+            initializer=_init_worker,
+            # A pool process only builds workbooks, it doesn't need the
+            # templates and eligibility index a warm start loads.
+            initargs=({'SQLALCHEMY_DATABASE_URI': current_app.config['SQLALCHEMY_DATABASE_URI'], 'WARM_START': False},))
+    try:
+        future = _pool.submit(build_artifact, survey_id, path)
+    except BrokenProcessPool:
+        # A pool process died, eg. killed for using too much memory.
+        _pool = None
+        return _submit(survey_id, path)
+    future.add_done_callback(_log_failure)
+    _builds[path] = future
+
+
+def request_export(survey):
+    """Returns the path of the survey's cached export if it is up to date.
+
+    Otherwise makes sure it is being built and returns None; call again
+    later to see if it is ready.
+    """
+
+    cache_dir = current_app.config['EXPORT_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+    path = artifact_path(cache_dir, survey.survey_id, survey.completes or 0)
+    if os.path.exists(path):
+        return path
+
+    with _lock:
+        for done_path in [done_path for done_path, future in _builds.items() if future.done()]:
+            del _builds[done_path]
+        if not _is_building(path):
+            _submit(survey.survey_id, path)
+    return None
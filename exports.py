@@ -0,0 +1,214 @@
+import re
+import tempfile
+import time
+import zipfile
+from collections import Counter
+from datetime import date
+import xlsxwriter
+from __init__ import db
+from models import Panelist, Survey, Question, Answer, Response, RACES, GENDERS, REGIONS, name_of
+
+
+# Column headers of the exported worksheet, in order.
+EXPORT_COLUMNS = ['Question', 'Response', 'Age', 'Gender', 'Race', 'Region']
+
+# How many joined rows to pull from the DB at a time.
+EXPORT_CHUNK_SIZE = 1000
+
+# Column headers of the summary worksheet of a bulk export, in order.
+SUMMARY_COLUMNS = ['Survey ID', 'Survey', 'Question', 'Answer', 'Responses', 'Percent']
+
+# Bytes copied into a bulk export archive at a time.
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+
+
+def survey_response_rows(survey_id, chunk_size=EXPORT_CHUNK_SIZE):
+    """Returns a query over every response to a survey, joined to its question
+    and panelist, that fetches chunk_size rows at a time.
+
+    Each row is (question, answer text, dob, gender_id, race_id, region_id,
+    answer_id).  This
+    replaces walking survey.responses and lazy loading the parent question
+    and panelist of each response, which was two SELECTs per row.
+    """
+
+    return db.session.query(
+        Question.question,
+        Answer.answer,
+        Panelist.dob,
+        Panelist.gender_id,
+        Panelist.race_id,
+        Panelist.region_id,
+        Response.answer_id
+    ).select_from(
+        Response
+    ).join(
+        Question, Question.question_id == Response.parent_question_id
+    ).join(
+        Answer, Answer.answer_id == Response.answer_id
+    ).join(
+        Panelist, Panelist.panelist_id == Response.response_panelist_id
+    ).filter(
+        Response.parent_survey_id == survey_id
+    ).order_by(
+        Response.response_id
+    ).execution_options(stream_results=True).yield_per(chunk_size)
+
+
+def write_survey_workbook(survey_id, output, answer_counts=None):
+    """Writes the responses of a survey to output as an .xlsx workbook.
+
+    output can be a filename or a file-like object.  The workbook uses
+    XlsxWriter's constant_memory mode, which flushes each row to a temp file
+    as soon as the next one starts, so memory use does not grow with the
+    number of responses.  Rows must be written in order for that to work,
+    which the query above guarantees.
+
+    If answer_counts is a Counter, the number of responses of each answer_id
+    is added to it along the way.
+
+    Returns the number of response rows written.
+    """
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+
+    for col_counter, name in enumerate(EXPORT_COLUMNS):
+        worksheet.write(0, col_counter, name)
+
+    this_year = date.today().year
+    row_counter = 0
+    for row_counter, (question, response, dob, gender_id, race_id, region_id, answer_id) in enumerate(
+            survey_response_rows(survey_id), start=1):
+        worksheet.write(row_counter, 0, question)
+        worksheet.write(row_counter, 1, response)
+        # Same calculation as Panelist.get_age without loading the Panelist.
+        worksheet.write(row_counter, 2, this_year - dob.year)
+        worksheet.write(row_counter, 3, name_of(GENDERS, gender_id))
+        worksheet.write(row_counter, 4, name_of(RACES, race_id))
+        worksheet.write(row_counter, 5, name_of(REGIONS, region_id))
+        if answer_counts is not None:
+            answer_counts[answer_id] += 1
+
+    workbook.close()
+    return row_counter
+
+
+def write_summary_workbook(surveys, answer_counts, output):
+    """Writes the number and percent of responses of every answer of some
+    surveys to output as an .xlsx workbook, one row per answer."""
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Summary')
+    for col_counter, name in enumerate(SUMMARY_COLUMNS):
+        worksheet.write(0, col_counter, name)
+
+    titles = dict((survey.survey_id, survey.title) for survey in surveys)
+    answers = db.session.query(
+        Question.parent_survey_id, Question.question_id, Question.question, Answer.answer_id, Answer.answer
+    ).join(
+        Answer, Answer.parent_question_id == Question.question_id
+    ).filter(
+        Question.parent_survey_id.in_(list(titles))
+    ).order_by(Question.parent_survey_id, Question.question_id, Answer.answer_id).all()
+
+    question_totals = Counter()
+    for survey_id, question_id, question, answer_id, answer in answers:
+        question_totals[question_id] += answer_counts[answer_id]
+
+    for row_counter, (survey_id, question_id, question, answer_id, answer) in enumerate(answers, start=1):
+        count = answer_counts[answer_id]
+        worksheet.write(row_counter, 0, survey_id)
+        worksheet.write(row_counter, 1, titles[survey_id])
+        worksheet.write(row_counter, 2, question)
+        worksheet.write(row_counter, 3, answer)
+        worksheet.write(row_counter, 4, count)
+        worksheet.write(row_counter, 5, round(100.0 * count / question_totals[question_id], 1) if question_totals[question_id] else 0)
+
+    workbook.close()
+
+
+class _ArchiveSink(object):
+    """Write-only file for zipfile that keeps what is written until it is
+    taken.  It can't seek, so zipfile streams each entry with a data
+    descriptor after it instead of going back to fill in its header."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _archive_file(archive, sink, name, source):
+    """Copies the file source into the archive as name, yielding the archive
+    bytes as they are produced."""
+
+    source.seek(0, 2)
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.file_size = source.tell()
+    # Workbooks are already zip compressed.
+    info.compress_type = zipfile.ZIP_STORED
+    source.seek(0)
+    with archive.open(info, 'w') as entry:
+        while True:
+            chunk = source.read(ARCHIVE_CHUNK_SIZE)
+            if not chunk:
+                break
+            entry.write(chunk)
+            data = sink.take()
+            if data:
+                yield data
+    # The entry's data descriptor, written on close.
+    yield sink.take()
+
+
+def stream_surveys_archive(survey_ids):
+    """Generates a ZIP archive with the export workbook of each survey and a
+    Summary.xlsx of their answer counts, chunk by chunk.
+
+    Each workbook is built into a temp file and copied into the archive
+    before the next one starts, and the answer counts for the summary are
+    taken while building them, so memory use doesn't grow with the number
+    of surveys or responses.
+    """
+
+    surveys = Survey.query.filter(Survey.survey_id.in_(survey_ids)).order_by(Survey.survey_id).all()
+    answer_counts = Counter()
+    sink = _ArchiveSink()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for survey in surveys:
+            name = '%d %s.xlsx' % (survey.survey_id, re.sub(r'[^\w\- ]', '', survey.title).strip())
+            with tempfile.TemporaryFile() as workbook:
+                write_survey_workbook(survey.survey_id, workbook, answer_counts)
+                for data in _archive_file(archive, sink, name, workbook):
+                    yield data
+
+        with tempfile.TemporaryFile() as workbook:
+            write_summary_workbook(surveys, answer_counts, workbook)
+            for data in _archive_file(archive, sink, 'Summary.xlsx', workbook):
+                yield data
+    # The central directory, written on close.
+    yield sink.take()
+
+
+def build_survey_export(survey_id):
+    """Builds the workbook for a survey into an anonymous temp file and
+    returns that file, rewound and ready to be streamed to the client.
+
+    The file is deleted by the OS as soon as it is closed.
+    """
+
+    output = tempfile.TemporaryFile()
+    write_survey_workbook(survey_id, output)
+    output.seek(0)
+    return output
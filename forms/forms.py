@@ -4,6 +4,10 @@ from wtforms import (
 from wtforms.fields.html5 import EmailField, DateField
 from flask_wtf import FlaskForm
 from wtforms import widgets, SelectMultipleField
+from sqlalchemy.orm import selectinload
+from collections import OrderedDict
+import threading
+from models import Question
 
 
 class RegistrationForm(Form):
@@ -164,4 +168,77 @@ class SurveyContentForm(FlaskForm):
 
 
 class IncentiveRedemption(FlaskForm):
-    amount = RadioField('Amount', coerce=int, choices=[(50, '$5 (50 pts.)'), (100, '$10 (100 pts.)'), (150, '$15 (150 pts.)')])
\ No newline at end of file
+    amount = RadioField('Amount', coerce=int, choices=[(50, '$5 (50 pts.)'), (100, '$10 (100 pts.)'), (150, '$15 (150 pts.)')])
+
+
+# Generated SurveyAnsweringForm classes keyed by survey_id.  Each value is
+# (content version, form class, field names).  The content version is the
+# survey's num_questions, which ask.create_survey bumps for every question,
+# so a worker that missed an invalidation still rebuilds a changed survey.
+_answering_forms = OrderedDict()
+_answering_forms_lock = threading.Lock()
+ANSWERING_FORM_CACHE_SIZE = 512
+
+
+def build_survey_answering_form(survey_id):
+    """Creates the form class used to answer a survey.
+
+    The class gets one RadioField per question, named 'q' + question_id,
+    with the question text as the label and its answers as the choices.
+    Each choice submits the answer_id of its answer.
+    The questions and all their answers are loaded with two queries.
+
+    Returns the class and the list of field names in question order.
+    """
+
+    # Define this form class in the function per WTForms doc. The form fields
+    # have to be created dynamically or else they will not be bound correctly
+    # to the form object.
+    class SurveyAnsweringForm(FlaskForm):
+        pass
+
+    questions = Question.query.filter_by(
+        parent_survey_id=survey_id
+    ).options(selectinload(Question.answers)).order_by(Question.question_id).all()
+
+    list_of_attributes = []
+    for question in questions:
+        setattr(
+            SurveyAnsweringForm,
+            'q' + str(question.question_id),
+            RadioField(
+                str(question.question), coerce=int,
+                choices=[(answer.answer_id, answer.answer) for answer in question.answers])
+            )
+        list_of_attributes.append('q' + str(question.question_id))
+
+    return SurveyAnsweringForm, list_of_attributes
+
+
+def get_survey_answering_form(survey):
+    """Returns the cached (form class, field names) for a Survey, building
+    them on a miss or when the survey's questions have changed."""
+
+    version = survey.num_questions
+    with _answering_forms_lock:
+        cached = _answering_forms.get(survey.survey_id)
+        if cached is not None and cached[0] == version:
+            _answering_forms.move_to_end(survey.survey_id)
+            return cached[1], cached[2]
+
+    form_class, list_of_attributes = build_survey_answering_form(survey.survey_id)
+
+    with _answering_forms_lock:
+        _answering_forms[survey.survey_id] = (version, form_class, list_of_attributes)
+        _answering_forms.move_to_end(survey.survey_id)
+        while len(_answering_forms) > ANSWERING_FORM_CACHE_SIZE:
+            _answering_forms.popitem(last=False)
+
+    return form_class, list_of_attributes
+
+
+def invalidate_survey_answering_form(survey_id):
+    """Drops the cached form class of a survey, eg. after adding a question."""
+
+    with _answering_forms_lock:
+        _answering_forms.pop(survey_id, None)
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+from markupsafe import Markup
+
+
+class FragmentCache(object):
+    """Caches rendered HTML fragments of a page per panelist.
+
+    Every fragment is stored with the global version and the panelist's own
+    version at the time it was rendered, and is only served while both are
+    unchanged.  Views bump the versions when something a fragment shows
+    changes:
+
+    bump_user(panelist_id): the panelist submitted, published or redeemed.
+    bump_global(): a survey opened, closed or changed, which can change what
+        every panelist sees.
+
+    Versions live in this process only, so a change made through another
+    gunicorn worker is picked up once the fragment is older than
+    ttl_seconds.
+    """
+
+    def __init__(self, max_size=4096, ttl_seconds=30):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._global_version = 0
+        self._user_versions = {}
+        self._entries = OrderedDict()
+
+    def bump_global(self):
+        with self._lock:
+            self._global_version += 1
+
+    def bump_user(self, panelist_id):
+        with self._lock:
+            self._user_versions[panelist_id] = self._user_versions.get(panelist_id, 0) + 1
+
+    def get_or_render(self, panelist_id, section, render):
+        """Returns the cached fragment for (panelist_id, section), or calls
+        render() to produce it.  render should run any queries the fragment
+        needs so that they are skipped entirely on a hit."""
+
+        key = (panelist_id, section)
+        with self._lock:
+            versions = (self._global_version, self._user_versions.get(panelist_id, 0))
+            entry = self._entries.get(key)
+            if (entry is not None and entry[0] == versions
+                    and time.time() - entry[1] <= self.ttl_seconds):
+                self._entries.move_to_end(key)
+                return entry[2]
+
+        html = Markup(render())
+
+        with self._lock:
+            self._entries[key] = (versions, time.time(), html)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return html
+
+
+# The sections of the /home/ dashboard.  One cache per process.
+home_fragments = FragmentCache()
@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+from flask import current_app, has_request_context, session
+from sqlalchemy.orm import make_transient_to_detached
+from __init__ import db
+from models import Panelist
+
+
+# The Panelist columns the site needs to authenticate and render a page for
+# the logged in panelist.  The password hash is deliberately left out; it is
+# loaded from the DB if anything ever asks for it.
+IDENTITY_FIELDS = (
+    'panelist_id', 'email', 'firstname', 'lastname', 'dob', 'race_id', 'gender_id',
+    'region_id', 'joined_date', 'point_balance', 'redeemed_challenge_1',
+    'redeemed_challenge_2')
+
+# Key in the Flask session used by the signed-session mode.
+SESSION_KEY = '_identity'
+
+
+class IdentityCache(object):
+    """A bounded LRU of panelist identity fields with a TTL.
+
+    Flask-Login's user_loader runs on every authenticated request.  Instead of
+    Panelist.query.get each time, load_panelist keeps the IDENTITY_FIELDS of
+    recently seen panelists here and rebuilds the Panelist from them without
+    any SQL.  Entries older than ttl_seconds are reloaded, which bounds how
+    stale another gunicorn worker's copy can get.
+    """
+
+    def __init__(self, max_size=1024, ttl_seconds=30):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clear()
+
+    def get(self, panelist_id):
+        with self._lock:
+            entry = self._entries.get(panelist_id)
+            if entry is None:
+                return None
+            loaded_at, fields = entry
+            if time.time() - loaded_at > self.ttl_seconds:
+                del self._entries[panelist_id]
+                return None
+            self._entries.move_to_end(panelist_id)
+            return fields
+
+    def put(self, panelist_id, fields):
+        with self._lock:
+            self._entries[panelist_id] = (time.time(), fields)
+            self._entries.move_to_end(panelist_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, panelist_id):
+        with self._lock:
+            self._entries.pop(panelist_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# One cache per process.  create_app configures its size and TTL.
+identity_cache = IdentityCache()
+
+
+def identity_fields(panelist):
+    return dict((field, getattr(panelist, field)) for field in IDENTITY_FIELDS)
+
+
+def panelist_from_fields(fields):
+    """Rebuilds a Panelist from cached fields and attaches it to the session
+    as if it had just been queried, so relationships and attributes that
+    aren't cached still load normally."""
+
+    panelist = Panelist(**fields)
+    make_transient_to_detached(panelist)
+    return db.session.merge(panelist, load=False)
+
+
+def _session_identity(panelist_id):
+    """The identity carried in the signed session cookie, if it is for this
+    panelist and still fresh."""
+
+    entry = session.get(SESSION_KEY)
+    if not entry or entry.get('fields', {}).get('panelist_id') != panelist_id:
+        return None
+    if time.time() - entry.get('loaded_at', 0) > identity_cache.ttl_seconds:
+        return None
+    # The session's JSON has no date type, so dob is kept as an ISO string.
+    fields = dict(entry['fields'])
+    if fields.get('dob'):
+        fields['dob'] = date.fromisoformat(fields['dob'])
+    return fields
+
+
+def load_panelist(panelist_id):
+    """Returns the Panelist with the given id for Flask-Login.
+
+    Looks in the signed session first when IDENTITY_IN_SESSION is set, then
+    in the identity cache, and only queries the DB on a miss.  Returns None if
+    there is no such panelist.
+    """
+
+    in_session = current_app.config.get('IDENTITY_IN_SESSION')
+
+    fields = _session_identity(panelist_id) if in_session else None
+    if fields is None:
+        fields = identity_cache.get(panelist_id)
+    if fields is not None:
+        return panelist_from_fields(fields)
+
+    panelist = Panelist.query.get(panelist_id)
+    if panelist is None:
+        return None
+
+    fields = identity_fields(panelist)
+    identity_cache.put(panelist_id, fields)
+    if in_session:
+        session_fields = dict(fields)
+        if session_fields.get('dob'):
+            session_fields['dob'] = session_fields['dob'].isoformat()
+        session[SESSION_KEY] = {'loaded_at': time.time(), 'fields': session_fields}
+    return panelist
+
+
+def invalidate(panelist_id):
+    """Forget the cached identity of a panelist after their profile or
+    balance changes.
+
+    Clears this worker's cache and, if the change was made in the panelist's
+    own request, the copy in their session.  Other workers catch up within
+    the TTL.
+    """
+
+    identity_cache.invalidate(panelist_id)
+    if has_request_context():
+        entry = session.get(SESSION_KEY)
+        if entry and entry.get('fields', {}).get('panelist_id') == panelist_id:
+            session.pop(SESSION_KEY)
@@ -0,0 +1,210 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from flask import current_app, g, has_app_context, request, signals_available, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds and in statements.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Slowest statements of a request kept for the slow-request log.
+SLOWEST_STATEMENTS = 3
+
+
+class Histogram(object):
+    """Cumulative histogram per endpoint, in the Prometheus sense."""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, endpoint, value):
+        series = self._series.get(endpoint)
+        if series is None:
+            # One count per bucket plus +Inf, then the sum.
+            series = self._series[endpoint] = [0] * (len(self.buckets) + 1) + [0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def exposition(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s histogram' % self.name]
+        for endpoint in sorted(self._series):
+            series = self._series[endpoint]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (self.name, endpoint, bound, cumulative))
+            lines.append('%s_sum{endpoint="%s"} %s' % (self.name, endpoint, series[-1]))
+            lines.append('%s_count{endpoint="%s"} %d' % (self.name, endpoint, cumulative))
+        return lines
+
+
+class RequestMetrics(object):
+    """The request latency, SQL time and query count histograms of this
+    process, tagged by endpoint.  Each gunicorn worker keeps its own, so
+    Prometheus sees one series per worker it scrapes.
+
+    Also the time each phase of create_app took and how long the first
+    request of the process took, to keep an eye on cold starts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latency = Histogram(
+            'amplify_request_duration_seconds', 'Time to handle a request.', LATENCY_BUCKETS)
+        self.sql_time = Histogram(
+            'amplify_request_sql_seconds', 'Time spent running SQL per request.', LATENCY_BUCKETS)
+        self.query_count = Histogram(
+            'amplify_request_queries', 'SQL statements per request.', QUERY_COUNT_BUCKETS)
+        self.startup_phases = []  # (phase, seconds)
+        self.first_request = None  # (endpoint, seconds)
+
+    def record_startup(self, phases):
+        with self._lock:
+            self.startup_phases = list(phases)
+
+    def observe(self, endpoint, seconds, sql_seconds, queries):
+        with self._lock:
+            if self.first_request is None:
+                self.first_request = (endpoint, seconds)
+            self.latency.observe(endpoint, seconds)
+            self.sql_time.observe(endpoint, sql_seconds)
+            self.query_count.observe(endpoint, queries)
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+
+        with self._lock:
+            lines = self.latency.exposition() + self.sql_time.exposition() + self.query_count.exposition()
+            if self.startup_phases:
+                lines.append('# HELP amplify_startup_phase_seconds Time spent in each phase of create_app.')
+                lines.append('# TYPE amplify_startup_phase_seconds gauge')
+                for phase, seconds in self.startup_phases:
+                    lines.append('amplify_startup_phase_seconds{phase="%s"} %s' % (phase, seconds))
+            if self.first_request is not None:
+                lines.append('# HELP amplify_first_request_seconds Time to handle the first request of this process.')
+                lines.append('# TYPE amplify_first_request_seconds gauge')
+                lines.append('amplify_first_request_seconds{endpoint="%s"} %s' % self.first_request)
+        return '\n'.join(lines) + '\n'
+
+
+# One set of metrics per process.
+request_metrics = RequestMetrics()
+
+
+class RequestStats(object):
+    """What one request did, kept in g while it runs."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self.slowest = []  # (seconds, statement), slowest first
+        self._render_started_at = None
+
+    def record_statement(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        if len(self.slowest) < SLOWEST_STATEMENTS or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[SLOWEST_STATEMENTS:]
+
+
+def _current_stats():
+    if not has_app_context():
+        return None
+    return g.get('_request_stats')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['_query_started_at'].pop()
+    stats = _current_stats()
+    if stats is not None:
+        stats.record_statement(statement, seconds)
+
+
+def _handle_error(context):
+    # after_cursor_execute doesn't run for a failed statement.
+    if context.connection is not None:
+        started_at = context.connection.info.get('_query_started_at')
+        if started_at:
+            started_at.pop()
+
+
+def _before_render_template(app, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None:
+        stats._render_started_at = time.perf_counter()
+
+
+def _template_rendered(app, template, context, **extra):
+    stats = _current_stats()
+    if stats is not None and stats._render_started_at is not None:
+        stats.render_seconds += time.perf_counter() - stats._render_started_at
+        stats._render_started_at = None
+
+
+def _before_request():
+    g._request_stats = RequestStats()
+
+
+def _after_request(response):
+    """Records the request in the histograms and logs it if it was slow.
+
+    Runs before the body of a streamed response is generated, so for those
+    (eg. the admin 'All rows' pages) only the time to the first byte counts.
+    """
+
+    stats = g.pop('_request_stats', None)
+    if stats is None:
+        return response
+    seconds = time.perf_counter() - stats.started_at
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe(endpoint, seconds, stats.sql_seconds, stats.queries)
+
+    if seconds * 1000 >= current_app.config['SLOW_REQUEST_MS']:
+        logger.warning(
+            'Slow request: %s %s (%s) took %.0f ms, %d queries in %.0f ms, rendering %.0f ms. Slowest statements:%s',
+            request.method, request.path, endpoint, seconds * 1000, stats.queries,
+            stats.sql_seconds * 1000, stats.render_seconds * 1000,
+            ''.join('\n  %.1f ms: %s' % (s * 1000, ' '.join(statement.split())[:500])
+                    for s, statement in stats.slowest))
+    return response
+
+
+def init_app(app):
+    """Hooks the instrumentation into the app.
+
+    SQL statements are timed through engine events (registered once for every
+    engine) and attributed to the request running in the same app context.
+    Render time needs Flask's template signals, so it reads 0 unless blinker
+    is installed.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    if signals_available:
+        before_render_template.connect(_before_render_template, app)
+        template_rendered.connect(_template_rendered, app)
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,113 @@
+"""The one place that changes a panelist's points.
+
+Panelist.point_balance is the running balance that the site displays.  It is
+only ever changed here, with a single UPDATE ... SET point_balance =
+point_balance +/- n, and every change appends a PointTransaction in the same
+DB transaction.  Nothing is read into Python and written back, so concurrent
+workers can't overwrite each other's changes and no row locks are needed.
+
+None of these functions commit.  The caller commits along with whatever else
+the request writes (the responses of a survey, the Redemption row, ...), and
+then calls identity.invalidate(panelist_id), so that no request can cache
+the balance from before the commit.
+"""
+from sqlalchemy import func
+from __init__ import db
+from models import Panelist, PointTransaction, PointSnapshot
+
+
+def grant(panelist_id, amount, reason):
+    """Adds amount points to a panelist's balance.  amount must be positive.
+    Returns True if the points were granted and False otherwise."""
+
+    if amount is None or amount <= 0:
+        return False
+
+    Panelist.query.filter(Panelist.panelist_id == panelist_id).update(
+        {Panelist.point_balance: Panelist.point_balance + amount},
+        synchronize_session=False)
+    db.session.add(PointTransaction(panelist_id=panelist_id, amount=amount, reason=reason))
+    return True
+
+
+def debit(panelist_id, amount, reason):
+    """Takes amount points from a panelist's balance if they have enough.
+    amount must be positive, a negative debit would be a grant.
+
+    The balance check and the debit are one conditional UPDATE, so two
+    redemptions racing each other can't both spend the same points.
+    Returns True if the points were debited and False otherwise.
+    """
+
+    if amount is None or amount <= 0:
+        return False
+
+    debited = Panelist.query.filter(
+        Panelist.panelist_id == panelist_id,
+        Panelist.point_balance >= amount
+    ).update(
+        {Panelist.point_balance: Panelist.point_balance - amount},
+        synchronize_session=False)
+
+    if debited == 0:
+        return False
+
+    db.session.add(PointTransaction(panelist_id=panelist_id, amount=-amount, reason=reason))
+    return True
+
+
+def balance(panelist_id):
+    """Returns a panelist's balance according to the ledger.
+
+    This is the latest snapshot plus the ledger entries since it, so it only
+    sums the short tail since the snapshot rather than the whole history.
+    Use it to reconcile Panelist.point_balance against the ledger.
+    """
+
+    snapshot = PointSnapshot.query.get(panelist_id)
+    snapshot_balance = snapshot.balance if snapshot else 0
+    last_transaction_id = snapshot.last_transaction_id if snapshot else 0
+
+    tail = db.session.query(func.coalesce(func.sum(PointTransaction.amount), 0)).filter(
+        PointTransaction.panelist_id == panelist_id,
+        PointTransaction.transaction_id > last_transaction_id
+    ).scalar()
+
+    return snapshot_balance + tail
+
+
+def take_snapshots():
+    """Rolls every panelist's ledger tail into their PointSnapshot.
+
+    Only entries up to the current highest transaction_id are included so
+    that entries appended while this runs are picked up next time.  Does not
+    commit.  Returns the number of snapshots written.
+    """
+
+    high_water_mark = db.session.query(func.max(PointTransaction.transaction_id)).scalar()
+    if high_water_mark is None:
+        return 0
+
+    snapshots = dict((snapshot.panelist_id, snapshot) for snapshot in PointSnapshot.query)
+
+    # Sum each panelist's tail since their own snapshot in one grouped query.
+    tails = db.session.query(
+        PointTransaction.panelist_id, func.sum(PointTransaction.amount)
+    ).outerjoin(
+        PointSnapshot, PointSnapshot.panelist_id == PointTransaction.panelist_id
+    ).filter(
+        PointTransaction.transaction_id > func.coalesce(PointSnapshot.last_transaction_id, 0),
+        PointTransaction.transaction_id <= high_water_mark
+    ).group_by(PointTransaction.panelist_id)
+
+    written = 0
+    for panelist_id, tail in tails:
+        snapshot = snapshots.get(panelist_id)
+        if snapshot is None:
+            snapshot = PointSnapshot(panelist_id=panelist_id, balance=0)
+            db.session.add(snapshot)
+        snapshot.balance += tail
+        snapshot.last_transaction_id = high_water_mark
+        written += 1
+
+    return written
@@ -1,7 +1,41 @@
+from sqlalchemy import extract
 from sqlalchemy.sql import func
 from __init__ import db
 from flask_login import UserMixin
 from datetime import date
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The rows of the races, genders and regions tables in id order, as seeded by
+# devops.populate_reference_tables.  Panelists store the id of theirs as a
+# small integer code and surveys store the ones they target as a bitmask with
+# bit (id - 1) set for each.
+RACES = ['Black or African American', 'White', 'Asian', 'Hispanic or Latino', 'American Indian or Alaska Native', 'Native Hawaiian or Other Pacific Islander']
+GENDERS = ['Male', 'Female', 'Non-binary']
+REGIONS = ['Northeast', 'Midwest', 'West', 'South']
+
+
+def code_of(names, name):
+    """The id code of a name in RACES/GENDERS/REGIONS, or None."""
+    return names.index(name) + 1 if name in names else None
+
+
+def name_of(names, code):
+    return names[code - 1] if code else None
+
+
+def mask_of(codes):
+    """The targeting bitmask of some race/gender/region ids."""
+    mask = 0
+    for code in codes:
+        mask |= 1 << (int(code) - 1)
+    return mask
+
+
+def codes_in(mask):
+    return [bit + 1 for bit in range((mask or 0).bit_length()) if mask & (1 << bit)]
+
 
 # Subclass UserMixin so that I can use flask_login methods on the Panelist that
 # gets logged in.  Without subclassing, I would have to implement like 4 
@@ -28,10 +62,13 @@ class Panelist(UserMixin, db.Model):
     password = db.Column(db.String(140), nullable=False)
     firstname = db.Column(db.String(64))
     lastname = db.Column(db.String(64))
-    dob = db.Column(db.String(64))
-    race = db.Column(db.String(64))
-    gender = db.Column(db.String(64))
-    region = db.Column(db.String(64))
+    dob = db.Column(db.Date)
+    # Codes of the panelist's race, gender and region, ie. their ids in the
+    # reference tables.  The race, gender and region properties below give
+    # the names.
+    race_id = db.Column(db.SmallInteger, db.ForeignKey('races.race_id'))
+    gender_id = db.Column(db.SmallInteger, db.ForeignKey('genders.gender_id'))
+    region_id = db.Column(db.SmallInteger, db.ForeignKey('regions.region_id'))
     joined_date = db.Column(db.DateTime, server_default=func.now())
     point_balance = db.Column(db.Integer, default=0)
     
@@ -44,27 +81,59 @@ class Panelist(UserMixin, db.Model):
     # One-to-many relationship.  One panelist can have many redemptions.
     redemptions = db.relationship('Redemption', backref='redemption_panelist', lazy=True)
 
+    # One-to-many relationship.  One panelist can have many ledger entries.
+    point_transactions = db.relationship('PointTransaction', backref='transaction_panelist', lazy=True)
+
     # These are not exactly best practice.  Booleans for if a panelist has
     # claimed the challenge.  Oh well, it works and I am not scaling a product.
     redeemed_challenge_1 = db.Column(db.Boolean, default=0)
     redeemed_challenge_2 = db.Column(db.Boolean, default=0)
 
 
+    @property
+    def race(self):
+        return name_of(RACES, self.race_id)
+
+    @race.setter
+    def race(self, name):
+        self.race_id = code_of(RACES, name)
+
+    @property
+    def gender(self):
+        return name_of(GENDERS, self.gender_id)
+
+    @gender.setter
+    def gender(self, name):
+        self.gender_id = code_of(GENDERS, name)
+
+    @property
+    def region(self):
+        return name_of(REGIONS, self.region_id)
+
+    @region.setter
+    def region(self, name):
+        self.region_id = code_of(REGIONS, name)
+
     def get_age(self):
         """Returns an integer for the age of a panelist given their birthday"""
 
-        return date.today().year - int(self.dob[0:4])
+        return date.today().year - self.dob.year
+
+    @classmethod
+    def age_expression(cls):
+        """Same calculation as get_age, done by the DB."""
+
+        return date.today().year - extract('year', cls.dob)
 
     # This was giving me issues.  Sometimes the built-in get_id method of the
     # UserMixin class would not get called and so I had to implement my own.
     # This works on local machine but we shall see about hosted.
     def get_id(self):
-        #print(self.panelist_id)
         unicode_id = self.panelist_id
-        print('Get ID method of Panelist is returning ' + str(unicode_id))
+        logger.debug('Get ID method of Panelist is returning %s', unicode_id)
         return unicode_id
 
-    def get_eligible_surveys(self):
+    def get_eligible_surveys(self, limit=None, after_id=None):
         """Returns the Survey objects that a panelist qualifies for.
         
         A Panelist is only eligible for surveys where...
@@ -76,18 +145,29 @@ class Panelist(UserMixin, db.Model):
         Their Gender is in the survey's specified genders.
         Their Region is in the survey's specified regions.
         They have not already responded to the survey.
+
+        The filtering is done against the in-process EligibilityIndex, so
+        this only queries for the panelist's answered surveys and then for the
+        Survey rows themselves.
+
+        Surveys come back in survey_id order.  limit and after_id page through
+        them: only the ids of the requested page go into the query, which is
+        itself LIMITed.
         """
-        age = self.get_age()
+        # Imported here because eligibility.py imports these models.
+        from eligibility import eligibility_index
+
+        eligible_ids = sorted(eligibility_index.eligible_survey_ids(self))
+        if after_id is not None:
+            eligible_ids = [survey_id for survey_id in eligible_ids if survey_id > after_id]
+        if limit is not None:
+            eligible_ids = eligible_ids[:limit]
+        if not eligible_ids:
+            return []
+
         eligible_surveys = Survey.query.filter(
-            (Survey.min_age <= age),
-            (Survey.max_age >= age),
-            (Survey.status=='Open'),
-            (Survey.publisher_id != self.panelist_id),
-            (Survey.races.any(Race.race == self.race)),
-            (Survey.genders.any(Gender.gender == self.gender)),
-            (Survey.regions.any(Region.region == self.region)),
-            (~Survey.responses.any(Response.response_panelist_id == self.panelist_id))
-        ).all()
+            Survey.survey_id.in_(eligible_ids)
+        ).order_by(Survey.survey_id).limit(len(eligible_ids)).all()
         return eligible_surveys
 
 
@@ -122,25 +202,25 @@ class Region(db.Model):
 
 
 
-"""Junction tables needed to make the many-to-many relationships possible.
-These are passed in to the 'secondary' parameter in the db relationships
-in the Survey class. A Survey object can have many Race/Gender/Region 
-objects, and a Race/Gender/Region object can be referebced by many surveys.
+"""Junction tables that held the races/genders/regions a survey targets before
+the targeting moved to the bitmask columns of Survey.  Nothing writes to them
+any more; devops.encode_demographics reads them to fill in the masks of
+surveys created before then.
 """
 
 survey_races = db.Table('survey_races',
-    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id')),
-    db.Column('race_id', db.Integer, db.ForeignKey('races.race_id'))
+    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id'), index=True),
+    db.Column('race_id', db.Integer, db.ForeignKey('races.race_id'), index=True)
     )
 
 survey_genders = db.Table('survey_genders',
-    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id')),
-    db.Column('gender_id', db.Integer, db.ForeignKey('genders.gender_id'))
+    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id'), index=True),
+    db.Column('gender_id', db.Integer, db.ForeignKey('genders.gender_id'), index=True)
     )
 
 survey_regions = db.Table('survey_regions',
-    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id')),
-    db.Column('region_id', db.Integer, db.ForeignKey('regions.region_id'))
+    db.Column('survey_id', db.Integer, db.ForeignKey('surveys.survey_id'), index=True),
+    db.Column('region_id', db.Integer, db.ForeignKey('regions.region_id'), index=True)
     )
 
 
@@ -153,18 +233,26 @@ class Survey(db.Model):
 
     Important attributes:
     survey.questions: all of the questions for a survey.
-    survey.races: all of the races that a survey targets.
-    survey.genders: all of the genders that a survey targets.
-    survey.regions: all of the regions that a survey targets.
+    survey.race_mask/gender_mask/region_mask: the races/genders/regions that
+        a survey targets, with bit (id - 1) set for each targeted id.
+    survey.race_names/gender_names/region_names: the same as lists of names.
 
     Backrefs:
     survey.publisher: the panelist who published a survey.
     """
 
     __tablename__ = 'surveys'
-    __table_args__ = {'extend_existing': True} 
+    # The composite indexes serve the keyset pagination of answer.browse,
+    # which orders by (num_questions or create_date, survey_id), and the
+    # eligibility index, which loads Open surveys with their age range.
+    __table_args__ = (
+        db.Index('ix_surveys_status_min_age_max_age', 'status', 'min_age', 'max_age'),
+        db.Index('ix_surveys_num_questions_survey_id', 'num_questions', 'survey_id'),
+        db.Index('ix_surveys_create_date_survey_id', 'create_date', 'survey_id'),
+        {'extend_existing': True}
+        )
     survey_id = db.Column(db.Integer, primary_key=True)
-    publisher_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False) # the panelist_id of the publisher
+    publisher_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False, index=True) # the panelist_id of the publisher
     category = db.Column(db.String(64), nullable=False)
     title = db.Column(db.String(64), nullable=False)
     description = db.Column(db.String(64), nullable=False)
@@ -176,6 +264,9 @@ class Survey(db.Model):
     status = db.Column(db.String(64), default='Open')
     completes = db.Column(db.Integer, default=0)
     create_date = db.Column(db.DateTime, server_default=func.now())
+    race_mask = db.Column(db.Integer, nullable=False, default=0)
+    gender_mask = db.Column(db.Integer, nullable=False, default=0)
+    region_mask = db.Column(db.Integer, nullable=False, default=0)
 
     # One-to-many relationship.  One survey can have many questions.
     questions = db.relationship('Question', backref='parent_survey', lazy=True)
@@ -183,10 +274,17 @@ class Survey(db.Model):
     # One-to-many relationship.  One survey can have many responses.
     responses = db.relationship('Response', backref='parent_survey', lazy=True)
     
-    # Many-to-many relationship using junction tables survey_genders/races/...
-    genders = db.relationship('Gender', secondary=survey_genders, lazy='subquery', backref=db.backref('surveys', lazy=True))
-    races = db.relationship('Race', secondary=survey_races, lazy='subquery', backref=db.backref('surveys', lazy=True))
-    regions = db.relationship('Region', secondary=survey_regions, lazy='subquery', backref=db.backref('surveys', lazy=True))
+    @property
+    def race_names(self):
+        return [name_of(RACES, code) for code in codes_in(self.race_mask)]
+
+    @property
+    def gender_names(self):
+        return [name_of(GENDERS, code) for code in codes_in(self.gender_mask)]
+
+    @property
+    def region_names(self):
+        return [name_of(REGIONS, code) for code in codes_in(self.region_mask)]
 
     #def get_number_questions(self):
     #    num = Question.query.filter_by(parent_survey_id=self.survey_id).count()
@@ -210,7 +308,7 @@ class Question(db.Model):
     __tablename__ = 'questions'
     __table_args__ = {'extend_existing': True} 
     question_id = db.Column(db.Integer, primary_key=True)
-    parent_survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), nullable=False)
+    parent_survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), nullable=False, index=True)
     question = db.Column(db.String(140), nullable=False)
 
     # One-to-many relationship.  One question can have many answers.
@@ -230,25 +328,45 @@ class Answer(db.Model):
     __tablename__ = 'answers'
     __table_args__ = {'extend_existing': True} 
     answer_id = db.Column(db.Integer, primary_key=True)
-    parent_question_id = db.Column(db.Integer, db.ForeignKey('questions.question_id'), nullable=False)
+    parent_question_id = db.Column(db.Integer, db.ForeignKey('questions.question_id'), nullable=False, index=True)
     answer = db.Column(db.String(140), nullable=False)
 
+    # One-to-many relationship.  One answer can be picked by many responses.
+    responses = db.relationship('Response', backref='answer', lazy=True)
+
 
 class Response(db.Model):
     """Represents a panelist's response to a question of a survey.
 
+    The answer picked is stored as its answer_id, and its text is
+    response.answer.answer.  The respondent's demographic buckets at the time
+    are stored along with it.
+
     Usage:
     Survey.responses: Get all the responses to a particular survey.
     Panelist.responses: Get all the responses from a particular panelist.
     """
 
     __tablename__ = 'responses'
-    __table_args__ = {'extend_existing': True} 
+    # (panelist, survey) answers "which surveys has this panelist answered"
+    # and (survey, question) serves the results and export of a survey.
+    __table_args__ = (
+        db.Index('ix_responses_panelist_survey', 'response_panelist_id', 'parent_survey_id'),
+        db.Index('ix_responses_survey_question', 'parent_survey_id', 'parent_question_id'),
+        {'extend_existing': True}
+        )
     response_id = db.Column(db.Integer, primary_key=True)
     parent_survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), nullable=False)
-    parent_question_id = db.Column(db.Integer, db.ForeignKey('questions.question_id'), nullable=False)
+    parent_question_id = db.Column(db.Integer, db.ForeignKey('questions.question_id'), nullable=False, index=True)
     response_panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False)
-    response = db.Column(db.String(140), nullable=False)
+    answer_id = db.Column(db.Integer, db.ForeignKey('answers.answer_id'), nullable=False)
+    # The respondent's demographics when they answered, which the result
+    # tallies count them by.  Their age and profile can change afterwards.
+    # age_band is a tallies.AGE_BANDS label.
+    age_band = db.Column(db.String(8))
+    gender_id = db.Column(db.SmallInteger, db.ForeignKey('genders.gender_id'))
+    race_id = db.Column(db.SmallInteger, db.ForeignKey('races.race_id'))
+    region_id = db.Column(db.SmallInteger, db.ForeignKey('regions.region_id'))
 
 
 class Challenge(db.Model):
@@ -270,5 +388,121 @@ class Redemption(db.Model):
     redemption_id = db.Column(db.Integer, primary_key=True)
     redemption = db.Column(db.String(64), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
-    redemption_panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False)
+    redemption_panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False, index=True)
     redemption_date = db.Column(db.DateTime, server_default=func.now())
+
+
+class PointTransaction(db.Model):
+    """An entry in the append-only points ledger.
+
+    Every change to Panelist.point_balance goes through ledger.py, which
+    updates the balance and appends one of these in the same transaction.
+    Grants have a positive amount and debits a negative one.  Rows are never
+    updated or deleted.
+    """
+
+    __tablename__ = 'point_transactions'
+    __table_args__ = {'extend_existing': True}
+    transaction_id = db.Column(db.Integer, primary_key=True)
+    panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False, index=True)
+    amount = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(64), nullable=False)
+    transaction_date = db.Column(db.DateTime, server_default=func.now())
+
+
+class PointSnapshot(db.Model):
+    """A panelist's balance as of a given ledger entry.
+
+    A panelist's balance is the snapshot's balance plus the amounts of their
+    PointTransactions with a greater transaction_id, so only the tail since
+    the last snapshot ever has to be summed.  Snapshots are taken
+    periodically by devops.snapshot_point_balances.
+    """
+
+    __tablename__ = 'point_snapshots'
+    __table_args__ = {'extend_existing': True}
+    panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), primary_key=True)
+    balance = db.Column(db.Integer, nullable=False, default=0)
+    last_transaction_id = db.Column(db.Integer, nullable=False, default=0)
+    snapshot_date = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class SurveyQuota(db.Model):
+    """The open slots of a survey's sample.
+
+    Kept apart from the surveys table because it is decremented every time
+    someone opens the survey: quota.py only ever changes it with conditional
+    UPDATEs on this row, so concurrent workers never lock the survey itself.
+    slots_available + the survey's leases + its completes is its sample size.
+    """
+
+    __tablename__ = 'survey_quotas'
+    __table_args__ = {'extend_existing': True}
+    survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), primary_key=True)
+    slots_available = db.Column(db.Integer, nullable=False)
+
+
+class QuotaLease(db.Model):
+    """A slot held for a panelist while they answer a survey.
+
+    Confirmed (deleted) when they submit, or handed back to the survey's
+    SurveyQuota once expires_at has passed.
+    """
+
+    __tablename__ = 'quota_leases'
+    __table_args__ = (
+        db.UniqueConstraint('survey_id', 'panelist_id', name='uq_quota_leases_survey_panelist'),
+        {'extend_existing': True})
+    lease_id = db.Column(db.Integer, primary_key=True)
+    survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), nullable=False)
+    panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class SurveyCompletion(db.Model):
+    """Records that a panelist submitted a survey.
+
+    Inserted in the same transaction as the responses, and its primary key
+    is what stops a double submitted form from recording them twice.
+    """
+
+    __tablename__ = 'survey_completions'
+    __table_args__ = {'extend_existing': True}
+    survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), primary_key=True)
+    panelist_id = db.Column(db.Integer, db.ForeignKey('panelists.panelist_id'), primary_key=True)
+    completed_at = db.Column(db.DateTime, server_default=func.now())
+
+
+class ResponseTally(db.Model):
+    """How many respondents in a demographic bucket gave an answer.
+
+    dimension is 'Total' (with an empty bucket), 'Gender', 'Race', 'Region'
+    or 'Age' (bucketed into tallies.AGE_BANDS).  tallies.py creates a row for
+    every combination when a question is added and adds 1 to the matching
+    rows in the same transaction as each submission, so results never have
+    to scan the responses table.
+    """
+
+    __tablename__ = 'response_tallies'
+    __table_args__ = {'extend_existing': True}
+    answer_id = db.Column(db.Integer, db.ForeignKey('answers.answer_id'), primary_key=True)
+    dimension = db.Column(db.String(16), primary_key=True)
+    bucket = db.Column(db.String(140), primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey('questions.question_id'), nullable=False)
+    survey_id = db.Column(db.Integer, db.ForeignKey('surveys.survey_id'), nullable=False, index=True)
+    tally = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SurveysVersion(db.Model):
+    """A single row counting the changes to the surveys that the browse pages
+    show: one is created, gets a question or closes.
+
+    conditional.bump_surveys_version adds 1 to it along with each of those
+    changes, so browse can validate its ETag against this one row instead of
+    aggregating the whole surveys table.
+    """
+
+    __tablename__ = 'surveys_version'
+    __table_args__ = {'extend_existing': True}
+    surveys_version_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,162 @@
+"""Sample-size quotas for surveys.
+
+Each survey has a SurveyQuota row holding its open slots.  Opening a survey
+takes a slot and a QuotaLease for the panelist, submitting it confirms the
+lease, and leases that expire before they are confirmed go back to the pool.
+That way a survey never collects more than its sample size and panelists
+aren't handed surveys that are already full.  Each submission also records a
+SurveyCompletion, so the same panelist can't complete a survey twice.
+
+Every change is a conditional UPDATE or DELETE whose row count says whether
+it happened, so any number of gunicorn workers can race for the last slot
+without locking rows: exactly one of them sees its decrement go through.
+
+None of these functions commit.  The caller commits along with the rest of
+the request.
+"""
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from __init__ import db
+from models import SurveyQuota, QuotaLease, SurveyCompletion
+
+
+def create_quota(survey):
+    """Adds the quota of a new survey, with every slot open."""
+
+    db.session.flush()
+    db.session.add(SurveyQuota(survey_id=survey.survey_id, slots_available=survey.sample_size))
+
+
+def _ensure_quota(survey):
+    """Creates the quota of a survey from before quotas existed.  Returns
+    False if it already had one."""
+
+    if SurveyQuota.query.get(survey.survey_id) is not None:
+        return False
+    try:
+        with db.session.begin_nested():
+            db.session.add(SurveyQuota(
+                survey_id=survey.survey_id,
+                slots_available=max(survey.sample_size - (survey.completes or 0), 0)))
+    except IntegrityError:
+        # Another request created it first.
+        pass
+    return True
+
+
+def _take_slot(survey_id):
+    return SurveyQuota.query.filter(
+        SurveyQuota.survey_id == survey_id,
+        SurveyQuota.slots_available > 0
+    ).update(
+        {SurveyQuota.slots_available: SurveyQuota.slots_available - 1},
+        synchronize_session=False) == 1
+
+
+def _return_slots(survey_id, slots):
+    SurveyQuota.query.filter(SurveyQuota.survey_id == survey_id).update(
+        {SurveyQuota.slots_available: SurveyQuota.slots_available + slots},
+        synchronize_session=False)
+
+
+def _claim_slot(survey):
+    """Takes an open slot of a survey, reclaiming its expired leases or
+    creating its quota first if that is what it takes.  Returns False if the
+    survey is full."""
+
+    if _take_slot(survey.survey_id):
+        return True
+    if _ensure_quota(survey) or reclaim_expired_leases(survey.survey_id):
+        return _take_slot(survey.survey_id)
+    return False
+
+
+def reclaim_expired_leases(survey_id=None):
+    """Deletes expired leases, of one survey or of all of them, and returns
+    their slots to the quotas.
+
+    The DELETE repeats the expiry condition, so a lease that was confirmed
+    or extended in the meantime is left alone, and its row count is what gets
+    returned, so two workers reclaiming the same leases can't both return
+    them.  Returns the number of slots returned.
+    """
+
+    now = datetime.utcnow()
+    expired = db.session.query(QuotaLease.survey_id, QuotaLease.lease_id).filter(QuotaLease.expires_at < now)
+    if survey_id is not None:
+        expired = expired.filter(QuotaLease.survey_id == survey_id)
+
+    lease_ids_by_survey = {}
+    for lease_survey_id, lease_id in expired:
+        lease_ids_by_survey.setdefault(lease_survey_id, []).append(lease_id)
+
+    returned = 0
+    for lease_survey_id, lease_ids in lease_ids_by_survey.items():
+        deleted = QuotaLease.query.filter(
+            QuotaLease.lease_id.in_(lease_ids),
+            QuotaLease.expires_at < now
+        ).delete(synchronize_session=False)
+        if deleted:
+            _return_slots(lease_survey_id, deleted)
+            returned += deleted
+    return returned
+
+
+def acquire(survey, panelist_id):
+    """Holds a slot of a survey for a panelist for QUOTA_LEASE_MINUTES.
+
+    Opening the survey again just extends the lease the panelist already
+    has.  Returns False if the survey is full.
+    """
+
+    expires_at = datetime.utcnow() + timedelta(minutes=current_app.config['QUOTA_LEASE_MINUTES'])
+
+    if QuotaLease.query.filter(
+        QuotaLease.survey_id == survey.survey_id,
+        QuotaLease.panelist_id == panelist_id
+    ).update({QuotaLease.expires_at: expires_at}, synchronize_session=False):
+        return True
+
+    if not _claim_slot(survey):
+        return False
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(QuotaLease(survey_id=survey.survey_id, panelist_id=panelist_id, expires_at=expires_at))
+    except IntegrityError:
+        # The panelist opened the survey twice at once and the other request
+        # got the lease in, so hand this slot back.
+        _return_slots(survey.survey_id, 1)
+    return True
+
+
+def record_completion(survey, panelist_id):
+    """Records that a panelist submitted a survey.  Returns False if they
+    already did, eg. the same form was submitted twice at once: the second
+    insert of the (survey_id, panelist_id) key fails, or waits for the first
+    to commit and then fails."""
+
+    try:
+        with db.session.begin_nested():
+            db.session.add(SurveyCompletion(survey_id=survey.survey_id, panelist_id=panelist_id))
+    except IntegrityError:
+        return False
+    return True
+
+
+def confirm(survey, panelist_id):
+    """Turns a panelist's lease into a complete.
+
+    If their lease already expired and was reclaimed, they can still submit
+    as long as there is an open slot to take instead.  Returns False if the
+    survey filled up in the meantime.
+    """
+
+    if QuotaLease.query.filter(
+        QuotaLease.survey_id == survey.survey_id,
+        QuotaLease.panelist_id == panelist_id
+    ).delete(synchronize_session=False):
+        return True
+
+    return _claim_slot(survey)
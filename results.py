@@ -0,0 +1,109 @@
+from sqlalchemy.orm import selectinload
+from __init__ import db
+from models import Question, ResponseTally
+from tallies import AGE_BANDS, TOTAL
+
+
+# Demographic breakdowns shown on the results page, in order, with a fixed
+# ordering of their groups or None to sort them alphabetically.
+BREAKDOWNS = [
+    ('Gender', None),
+    ('Race', None),
+    ('Region', None),
+    ('Age', [label for label, youngest in AGE_BANDS]),
+]
+
+
+def _percent(count, total):
+    if not total:
+        return 0
+    return round(100.0 * count / total, 1)
+
+
+def survey_results(survey):
+    """Returns the aggregated results of a survey, one dict per question.
+
+    Every number comes from the survey's ResponseTally rows, so this runs two
+    queries (one for the questions and answers, one for the tallies) whatever
+    the number of respondents.
+
+    Each question dict has:
+    question: the Question object.
+    total: number of responses to the question.
+    answers: list of dicts with answer, count and percent of total.
+    breakdowns: list of dicts with a title, the columns (eg. each gender)
+        and rows of (answer, cells) where each cell is a dict with the count
+        and the percent of that column who gave that answer.
+    """
+
+    questions = Question.query.filter_by(
+        parent_survey_id=survey.survey_id
+    ).options(selectinload(Question.answers)).order_by(Question.question_id).all()
+
+    # question_id -> {answer_id: count} for the totals and question_id ->
+    # {(answer_id, group): count} per breakdown.  Groups nobody in the survey
+    # is in are left out.
+    totals = {}
+    counts_by_dimension = dict((title, {}) for title, fixed_order in BREAKDOWNS)
+    tallies = db.session.query(
+        ResponseTally.question_id, ResponseTally.answer_id, ResponseTally.dimension,
+        ResponseTally.bucket, ResponseTally.tally
+    ).filter(
+        ResponseTally.survey_id == survey.survey_id,
+        ResponseTally.tally > 0)
+    for question_id, answer_id, dimension, bucket, count in tallies:
+        if dimension == TOTAL:
+            totals.setdefault(question_id, {})[answer_id] = count
+        elif dimension in counts_by_dimension:
+            counts_by_dimension[dimension].setdefault(question_id, {})[(answer_id, bucket)] = count
+    breakdown_counts = [
+        (title, fixed_order, counts_by_dimension[title]) for title, fixed_order in BREAKDOWNS]
+
+    results = []
+    for question in questions:
+        answer_totals = totals.get(question.question_id, {})
+        total = sum(answer_totals.values())
+        # In the order they were authored.
+        answers = question.answers
+
+        breakdowns = []
+        for title, fixed_order, counts in breakdown_counts:
+            cell_counts = counts.get(question.question_id, {})
+            groups = set(group for answer_id, group in cell_counts)
+            if fixed_order is None:
+                columns = sorted(group for group in groups if group is not None)
+            else:
+                columns = [group for group in fixed_order if group in groups]
+            column_totals = dict(
+                (group, sum(count for (answer_id, g), count in cell_counts.items() if g == group))
+                for group in columns)
+            breakdowns.append({
+                'title': title,
+                'columns': columns,
+                'rows': [
+                    {
+                        'answer': answer.answer,
+                        'cells': [
+                            {
+                                'count': cell_counts.get((answer.answer_id, group), 0),
+                                'percent': _percent(cell_counts.get((answer.answer_id, group), 0), column_totals[group])
+                            }
+                            for group in columns]
+                    }
+                    for answer in answers]
+                })
+
+        results.append({
+            'question': question,
+            'total': total,
+            'answers': [
+                {
+                    'answer': answer.answer,
+                    'count': answer_totals.get(answer.answer_id, 0),
+                    'percent': _percent(answer_totals.get(answer.answer_id, 0), total)
+                }
+                for answer in answers],
+            'breakdowns': breakdowns
+            })
+
+    return results
@@ -0,0 +1,69 @@
+"""Routes the reads of read-only views to a read replica.
+
+When SQLALCHEMY_REPLICA_URI is set, create_app adds it as the 'replica'
+bind.  Views decorated with decorators.read_only call use_replica(), after
+which every query of the request goes to the replica.  Everything else, and
+every flush, stays on the primary.
+
+A panelist who wrote something in the last REPLICA_STALENESS_SECONDS keeps
+reading from the primary, so right after answering a survey or adding a
+question they see their own writes even if the replica lags behind.  The
+views making such writes call record_write() after committing, which keeps
+the time in their Flask session.
+"""
+import time
+from flask import current_app, g, has_app_context, has_request_context, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+
+REPLICA_BIND = 'replica'
+
+# Key in the Flask session holding the time of the panelist's last commit.
+LAST_WRITE_KEY = '_last_write'
+
+
+def reads_from_replica():
+    return has_app_context() and g.get('_read_replica', False)
+
+
+def use_replica():
+    """Sends the rest of this request's queries to the replica.  Does nothing
+    and returns False if there is no replica or the current panelist wrote
+    something too recently to trust it."""
+
+    if REPLICA_BIND not in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    if has_request_context():
+        last_write = flask_session.get(LAST_WRITE_KEY)
+        if last_write and time.time() - last_write < current_app.config['REPLICA_STALENESS_SECONDS']:
+            return False
+    g._read_replica = True
+    return True
+
+
+def record_write():
+    """Call after committing something the read-only views show, so that
+    the panelist reads from the primary for the next
+    REPLICA_STALENESS_SECONDS.  Commits that only change what they can't see,
+    like the quota lease taken when a survey is opened, don't, so opening a
+    survey doesn't pin the panelist to the primary or rewrite their cookie."""
+
+    if has_request_context():
+        flask_session[LAST_WRITE_KEY] = time.time()
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and reads_from_replica():
+            return self.app.extensions['sqlalchemy'].db.get_engine(self.app, bind=REPLICA_BIND)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions can read from the replica bind."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,249 @@
+"""Memory-mapped columnar snapshots of a survey's responses, for crosstabs.
+
+build_snapshot writes one row per response into a directory of .npy
+files, one per column, all integer coded:
+
+    question: index into the snapshot's questions.
+    answer: index into the snapshot's answers.
+    age: 1 + index into tallies.AGE_BANDS, 0 if unknown.
+    gender, race, region: GENDERS/RACES/REGIONS ids, 0 if unknown.
+
+The demographics are the ones recorded with each response, the same ones
+the result tallies count, so crosstabs agree with the results page.
+
+plus meta.json with the question and answer ids and texts the codes refer
+to.  Snapshots live in SNAPSHOT_DIR as survey_<survey_id>_<completes>, so a
+new complete makes the snapshot stale, and each is written to a temporary
+directory and renamed into place so readers never see half of one.
+
+Reading maps the files instead of loading them, so a crosstab only pages in
+the columns it touches, and counts with numpy over whole columns at a time.
+Nothing is read from the DB, so slicing a survey of millions of responses
+every way an analyst likes puts no load on it.  Builds read from the read
+replica when there is one.
+"""
+import glob
+import json
+import os
+import shutil
+import threading
+import time
+from array import array
+from collections import OrderedDict
+import numpy
+from flask import current_app
+from __init__ import db
+from models import Survey, Question, Answer, Response, RACES, GENDERS, REGIONS
+from tallies import AGE_BANDS
+import routing
+
+
+COLUMNS = ('question', 'answer', 'age', 'gender', 'race', 'region')
+
+# Crosstab dimensions and the labels of their codes, from 1.
+DIMENSIONS = OrderedDict([
+    ('age', [label for label, youngest in AGE_BANDS]),
+    ('gender', GENDERS),
+    ('race', RACES),
+    ('region', REGIONS),
+])
+
+# How many joined rows to pull from the DB at a time while building.
+SNAPSHOT_CHUNK_SIZE = 10000
+
+# Snapshots kept open by this process.
+SNAPSHOT_CACHE_SIZE = 32
+
+_lock = threading.Lock()
+_snapshots = OrderedDict()
+
+
+class Snapshot(object):
+    """The memory-mapped columns of one snapshot."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta:
+            self.meta = json.load(meta)
+        self.path = path
+        self.completes = self.meta['completes']
+        self.rows = self.meta['rows']
+        self.columns = {}
+        for column in COLUMNS:
+            if self.rows:
+                self.columns[column] = numpy.load(os.path.join(path, column + '.npy'), mmap_mode='r')
+            else:
+                # An empty file can't be mapped.
+                self.columns[column] = numpy.zeros(0, dtype=numpy.int8)
+
+    def crosstab(self, question_id=None, by=(), filters=None):
+        """Counts the responses per answer and per combination of the by
+        dimensions, among the responses to question_id (or every question)
+        from panelists matching filters, a dict of dimension -> list of
+        labels to keep.
+
+        Returns a list of dicts with question_id, answer_id, answer, the label
+        of each by dimension and the count, for every combination that has
+        any responses.  Raises ValueError on an unknown question, dimension
+        or label.
+        """
+
+        for dimension in list(by) + list(filters or {}):
+            if dimension not in DIMENSIONS:
+                raise ValueError('Unknown dimension: %s' % dimension)
+
+        mask = numpy.ones(self.rows, dtype=bool)
+        if question_id is not None:
+            question_ids = [question[0] for question in self.meta['questions']]
+            if question_id not in question_ids:
+                raise ValueError('Unknown question: %s' % question_id)
+            mask &= self.columns['question'] == question_ids.index(question_id)
+        for dimension, labels in (filters or {}).items():
+            codes = []
+            for label in labels:
+                if label not in DIMENSIONS[dimension]:
+                    raise ValueError('Unknown %s: %s' % (dimension, label))
+                codes.append(DIMENSIONS[dimension].index(label) + 1)
+            mask &= numpy.isin(self.columns[dimension], codes)
+
+        # One integer per combination of answer and by codes, counted with a
+        # single bincount.
+        shape = [len(self.meta['answers'])] + [len(DIMENSIONS[dimension]) + 1 for dimension in by]
+        keys = self.columns['answer'][mask].astype(numpy.int64)
+        for dimension, size in zip(by, shape[1:]):
+            keys = keys * size + self.columns[dimension][mask]
+        counts = numpy.bincount(keys, minlength=int(numpy.prod(shape))).reshape(shape)
+
+        cells = []
+        for index in zip(*numpy.nonzero(counts)):
+            answer_id, answer_question_id, answer = self.meta['answers'][index[0]]
+            cell = OrderedDict([('question_id', answer_question_id), ('answer_id', answer_id), ('answer', answer)])
+            for dimension, code in zip(by, index[1:]):
+                cell[dimension] = DIMENSIONS[dimension][code - 1] if code else None
+            cell['count'] = int(counts[index])
+            cells.append(cell)
+        return cells
+
+
+def snapshot_path(snapshot_dir, survey_id, completes):
+    return os.path.join(snapshot_dir, 'survey_%d_%d' % (survey_id, completes))
+
+
+def _snapshot_paths(snapshot_dir, survey_id):
+    """(completes, path) of the survey's snapshots, newest first."""
+
+    paths = []
+    for path in glob.glob(os.path.join(snapshot_dir, 'survey_%d_*' % survey_id)):
+        completes = os.path.basename(path).rsplit('_', 1)[1]
+        if completes.isdigit():
+            paths.append((int(completes), path))
+    return sorted(paths, reverse=True)
+
+
+def _response_rows(survey_id):
+    return db.session.query(
+        Response.parent_question_id,
+        Response.answer_id,
+        Response.age_band,
+        Response.gender_id,
+        Response.race_id,
+        Response.region_id
+    ).filter(
+        Response.parent_survey_id == survey_id
+    ).execution_options(stream_results=True).yield_per(SNAPSHOT_CHUNK_SIZE)
+
+
+def build_snapshot(survey_id):
+    """Writes a snapshot of a survey's responses and deletes its older ones.
+    Needs an app context.  Returns the snapshot's path."""
+
+    routing.use_replica()
+    survey = Survey.query.get(survey_id)
+    completes = survey.completes or 0
+    questions = db.session.query(Question.question_id, Question.question).filter(
+        Question.parent_survey_id == survey_id).order_by(Question.question_id).all()
+    answers = db.session.query(Answer.answer_id, Answer.parent_question_id, Answer.answer).join(
+        Question, Question.question_id == Answer.parent_question_id
+    ).filter(Question.parent_survey_id == survey_id).order_by(Answer.answer_id).all()
+    question_codes = dict((question_id, code) for code, (question_id, question) in enumerate(questions))
+    answer_codes = dict((answer_id, code) for code, (answer_id, question_id, answer) in enumerate(answers))
+
+    # Columns are collected in typed arrays, so a few million rows take a few
+    # bytes each rather than a Python int each.
+    columns = dict((column, array('i')) for column in COLUMNS)
+    age_codes = dict((label, code) for code, label in enumerate(DIMENSIONS['age'], start=1))
+    for question_id, answer_id, age_band, gender_id, race_id, region_id in _response_rows(survey_id):
+        columns['question'].append(question_codes[question_id])
+        columns['answer'].append(answer_codes[answer_id])
+        columns['age'].append(age_codes.get(age_band, 0))
+        columns['gender'].append(gender_id or 0)
+        columns['race'].append(race_id or 0)
+        columns['region'].append(region_id or 0)
+
+    snapshot_dir = current_app.config['SNAPSHOT_DIR']
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = snapshot_path(snapshot_dir, survey_id, completes)
+    partial = '%s.%d.partial' % (path, os.getpid())
+    os.makedirs(partial)
+    try:
+        for column, values in columns.items():
+            values = numpy.frombuffer(values, dtype=numpy.int32) if values else numpy.zeros(0, dtype=numpy.int32)
+            # The smallest type that holds the column's codes.
+            numpy.save(os.path.join(partial, column + '.npy'), values.astype(numpy.min_scalar_type(int(values.max()) if len(values) else 0)))
+        with open(os.path.join(partial, 'meta.json'), 'w') as meta:
+            json.dump(dict(
+                survey_id=survey_id, completes=completes, rows=len(columns['question']), built_at=time.time(),
+                questions=[list(question) for question in questions],
+                answers=[list(answer) for answer in answers]), meta)
+        os.rename(partial, path)
+    except OSError:
+        shutil.rmtree(partial, ignore_errors=True)
+        # Another process finished the same snapshot first.
+        if not os.path.isdir(path):
+            raise
+
+    for old_completes, old_path in _snapshot_paths(snapshot_dir, survey_id):
+        if old_path != path:
+            # Processes that have it open keep their mapping.
+            shutil.rmtree(old_path, ignore_errors=True)
+    return path
+
+
+def _open(path):
+    with _lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is not None:
+            _snapshots.move_to_end(path)
+            return snapshot
+
+    snapshot = Snapshot(path)
+
+    with _lock:
+        _snapshots[path] = snapshot
+        _snapshots.move_to_end(path)
+        while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+            _snapshots.popitem(last=False)
+    return snapshot
+
+
+def get_snapshot(survey):
+    """The newest snapshot of a survey.
+
+    It is rebuilt first if there is none, or if the survey has had new
+    completes since and the snapshot is over SNAPSHOT_REFRESH_SECONDS old.
+    Otherwise crosstabs may lag behind the latest completes, and
+    devops.build_snapshots() brings them up to date.
+    """
+
+    snapshot_dir = current_app.config['SNAPSHOT_DIR']
+    paths = _snapshot_paths(snapshot_dir, survey.survey_id)
+    if paths:
+        completes, path = paths[0]
+        try:
+            stale = (completes != (survey.completes or 0)
+                     and time.time() - os.path.getmtime(path) > current_app.config['SNAPSHOT_REFRESH_SECONDS'])
+            if not stale:
+                return _open(path)
+        except OSError:
+            # Deleted by a newer build in the meantime.
+            pass
+    return _open(build_snapshot(survey.survey_id))
@@ -0,0 +1,204 @@
+"""Creates whole surveys from JSON definitions.
+
+A definition is a dict of SurveyDetailsForm fields plus its questions, eg.
+
+    {
+        "title": "Commuting habits",
+        "category": "Travel and Lodging",
+        "survey_description": "How do you get to work?",
+        "sample_size": 200,
+        "min_age": 18,
+        "max_age": 65,
+        "race": [1, 2, 3, 4, 5, 6],
+        "gender": [1, 2, 3],
+        "region": [1, 2, 3, 4],
+        "questions": [
+            {"question_text": "How do you usually commute?", "answers": ["Car", "Bus", "Train", "Bike", "Walk"]}
+        ]
+    }
+
+and a batch is a list of them, or {"surveys": [...]}.  Every survey is
+checked against the SurveyDetailsForm rules and every question against the
+SurveyContentForm rules before anything is written, then the whole batch is
+inserted in one transaction with one bulk insert per table.
+"""
+from sqlalchemy import func, select
+from werkzeug.datastructures import MultiDict
+from __init__ import db
+from forms import SurveyDetailsForm, SurveyContentForm
+from models import Survey, Question, Answer, SurveyQuota, ResponseTally, mask_of
+from eligibility import eligibility_index
+from fragments import home_fragments
+import conditional
+import routing
+import tallies
+
+
+# SurveyContentForm shows 4 answer boxes and accepts at most 5.
+MIN_ANSWERS = 2
+MAX_ANSWERS = 5
+
+DETAILS_FIELDS = ('title', 'category', 'survey_description', 'sample_size', 'min_age', 'max_age', 'race', 'gender', 'region')
+
+
+class SurveyImportError(ValueError):
+    """Raised with every problem found in a batch.  errors is a list of dicts
+    with the survey's index, the question's index if it is about a question,
+    the field and its messages."""
+
+    def __init__(self, errors):
+        ValueError.__init__(self, '%d problems in the survey definitions' % len(errors))
+        self.errors = errors
+
+
+def _formdata(definition, fields):
+    formdata = MultiDict()
+    for field in fields:
+        value = definition.get(field)
+        if isinstance(value, list):
+            for item in value:
+                formdata.add(field, str(item))
+        elif value is not None:
+            formdata.add(field, str(value))
+    return formdata
+
+
+def survey_definitions(payload):
+    """The list of survey definitions in a JSON payload."""
+
+    if isinstance(payload, dict) and 'surveys' in payload:
+        payload = payload['surveys']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not all(isinstance(definition, dict) for definition in payload):
+        raise SurveyImportError([{'survey': None, 'field': None, 'messages': ['Expected a survey, a list of surveys or {"surveys": [...]}.']}])
+    if not payload:
+        raise SurveyImportError([{'survey': None, 'field': None, 'messages': ['Expected at least one survey.']}])
+    return payload
+
+
+def validate(definitions):
+    """Checks every definition with the forms used by the Ask pages.  Needs
+    an app context.  Returns the cleaned (details form, [(question text,
+    answers)]) of each survey, or raises SurveyImportError."""
+
+    errors = []
+    cleaned = []
+    for survey_index, definition in enumerate(definitions):
+        details = SurveyDetailsForm(formdata=_formdata(definition, DETAILS_FIELDS), meta={'csrf': False})
+        if not details.validate():
+            for field, messages in details.errors.items():
+                errors.append({'survey': survey_index, 'field': field, 'messages': messages})
+
+        questions = definition.get('questions')
+        if not isinstance(questions, list) or not questions:
+            errors.append({'survey': survey_index, 'field': 'questions', 'messages': ['A survey needs at least one question.']})
+            questions = []
+
+        cleaned_questions = []
+        for question_index, question in enumerate(questions):
+            question = question if isinstance(question, dict) else {}
+            answers = question.get('answers') if isinstance(question.get('answers'), list) else []
+            formdata = _formdata(question, ['question_text'])
+            for answer_index, answer in enumerate(answers):
+                formdata.add('answers-%d' % answer_index, str(answer))
+            content = SurveyContentForm(formdata=formdata, meta={'csrf': False})
+            messages = {}
+            if not content.validate():
+                messages.update(content.errors)
+            answer_texts = [answer for answer in content.answers.data if answer != '']
+            if len(answers) > MAX_ANSWERS or len(answer_texts) < MIN_ANSWERS:
+                messages['answers'] = ['A question needs %d to %d answers.' % (MIN_ANSWERS, MAX_ANSWERS)]
+            for field, field_messages in messages.items():
+                errors.append({'survey': survey_index, 'question': question_index, 'field': field, 'messages': field_messages})
+            cleaned_questions.append((content.question_text.data, answer_texts))
+
+        cleaned.append((details, cleaned_questions))
+
+    if errors:
+        raise SurveyImportError(errors)
+    return cleaned
+
+
+def _allocate_ids(column, count):
+    """Reserves count new ids of an autoincrement primary key column.
+
+    On PostgreSQL they come from the column's sequence.  Elsewhere (SQLite)
+    they follow the current highest id, which is safe because the caller has
+    already written in this transaction and so holds the DB's write lock.
+    """
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        sequence = func.pg_get_serial_sequence(column.table.name, column.name)
+        return [row[0] for row in db.session.execute(
+            select([func.nextval(sequence)]).select_from(func.generate_series(1, count)))]
+
+    highest = db.session.query(func.coalesce(func.max(column), 0)).scalar()
+    return list(range(highest + 1, highest + count + 1))
+
+
+def import_surveys(payload, publisher_id):
+    """Creates every survey in a JSON payload for a publisher.
+
+    Validates the whole batch first, so nothing is created if any survey is
+    invalid.  Then inserts the surveys, and with one executemany each, all of
+    their questions, answers, result tallies and quotas, and commits once.
+    Returns the new survey_ids.
+    """
+
+    cleaned = validate(survey_definitions(payload))
+
+    surveys = []
+    for details, questions in cleaned:
+        survey = dict(
+            publisher_id=publisher_id,
+            category=details.category.data,
+            title=details.title.data,
+            description=details.survey_description.data,
+            sample_size=details.sample_size.data,
+            min_age=details.min_age.data,
+            max_age=details.max_age.data,
+            race_mask=mask_of(details.race.data),
+            gender_mask=mask_of(details.gender.data),
+            region_mask=mask_of(details.region.data),
+            num_questions=len(questions),
+            # Every question is 5 points, same as ask.create_survey.
+            point_value=5 * len(questions),
+            status='Open',
+            completes=0)
+        # Few surveys per batch, and inserting them one at a time gives their
+        # ids on every DB.
+        survey['survey_id'] = db.session.execute(
+            Survey.__table__.insert(), survey).inserted_primary_key[0]
+        surveys.append(survey)
+
+    all_questions = [question for details, questions in cleaned for question in questions]
+    question_ids = iter(_allocate_ids(Question.question_id, len(all_questions)))
+    answer_ids = iter(_allocate_ids(Answer.answer_id, sum(len(answers) for question_text, answers in all_questions)))
+    buckets = tallies.dimension_buckets()
+    question_rows, answer_rows, tally_rows = [], [], []
+    for survey, (details, questions) in zip(surveys, cleaned):
+        for question_text, answers in questions:
+            question_id = next(question_ids)
+            question_rows.append(dict(question_id=question_id, parent_survey_id=survey['survey_id'], question=question_text))
+            question_answer_ids = [next(answer_ids) for answer in answers]
+            answer_rows.extend(
+                dict(answer_id=answer_id, parent_question_id=question_id, answer=answer)
+                for answer_id, answer in zip(question_answer_ids, answers))
+            tally_rows.extend(tallies.question_tally_rows(survey['survey_id'], question_id, question_answer_ids, buckets))
+
+    db.session.execute(Question.__table__.insert(), question_rows)
+    db.session.execute(Answer.__table__.insert(), answer_rows)
+    db.session.execute(ResponseTally.__table__.insert(), tally_rows)
+    db.session.execute(SurveyQuota.__table__.insert(), [
+        dict(survey_id=survey['survey_id'], slots_available=survey['sample_size']) for survey in surveys])
+    conditional.bump_surveys_version()
+    db.session.commit()
+    routing.record_write()
+
+    for survey in surveys:
+        eligibility_index.add_survey(Survey(**survey))
+    home_fragments.bump_user(publisher_id)
+    home_fragments.bump_global()
+
+    return [survey['survey_id'] for survey in surveys]
@@ -0,0 +1,226 @@
+"""Pre-aggregated answer counts per question, answer and demographic bucket.
+
+Every question has a ResponseTally row for each of its answer_ids in each
+bucket of each dimension, created along with the question.  A submission
+adds 1 to the rows matching each of its answers and the respondent's
+buckets with one executemany UPDATE in the same transaction as the
+responses, so the tallies are never out of step with the responses table
+and reading them costs O(questions x answers) whatever the number of
+respondents.
+
+Each response records the respondent's age band, gender, race and region
+when they answered, and rebuild() and check() recount from those, so a
+birthday or a profile edit never changes past results.
+"""
+from sqlalchemy import and_, bindparam, case, func
+from __init__ import db
+from models import (
+    Panelist, Question, Answer, Response, ResponseTally, Race, Gender, Region,
+    RACES, GENDERS, REGIONS, name_of)
+
+
+# (label, youngest age in the band).  The last band is open ended.
+AGE_BANDS = [
+    ('18-24', 18),
+    ('25-34', 25),
+    ('35-44', 35),
+    ('45-54', 45),
+    ('55+', 55),
+]
+
+# Dimension of the row counting every respondent.
+TOTAL = 'Total'
+
+# Demographic dimensions, in the order the results page shows them.
+DIMENSIONS = ['Gender', 'Race', 'Region', 'Age']
+
+
+def age_band(age):
+    """The label of the AGE_BANDS band an age falls in."""
+
+    for (label, youngest), (next_label, next_youngest) in zip(AGE_BANDS, AGE_BANDS[1:]):
+        if age < next_youngest:
+            return label
+    return AGE_BANDS[-1][0]
+
+
+def age_band_expression():
+    """SQL expression for the age band of Panelist.dob, so that responses
+    can be grouped by it."""
+
+    age = Panelist.age_expression()
+    # A panelist falls in a band if they are younger than the next band.
+    whens = [
+        (age < AGE_BANDS[i + 1][1], AGE_BANDS[i][0])
+        for i in range(len(AGE_BANDS) - 1)]
+    return case(whens, else_=AGE_BANDS[-1][0])
+
+
+# dimension_buckets() of this process.  The reference tables only change in
+# devops.populate_reference_tables.
+_buckets = None
+
+
+def dimension_buckets():
+    """{dimension: every bucket of it}, from the reference tables.  Loaded
+    once per process."""
+
+    global _buckets
+    if _buckets is None:
+        buckets = {
+            TOTAL: [''],
+            'Gender': [gender for gender, in db.session.query(Gender.gender)],
+            'Race': [race for race, in db.session.query(Race.race)],
+            'Region': [region for region, in db.session.query(Region.region)],
+            'Age': [label for label, youngest in AGE_BANDS],
+        }
+        if not buckets['Gender']:
+            # Reference tables not populated yet, don't keep this.
+            return buckets
+        _buckets = buckets
+    return _buckets
+
+
+def panelist_buckets(panelist):
+    """[(dimension, bucket)] of the rows a panelist's answers count towards."""
+
+    return [
+        (TOTAL, ''),
+        ('Gender', panelist.gender),
+        ('Race', panelist.race),
+        ('Region', panelist.region),
+        ('Age', age_band(panelist.get_age())),
+    ]
+
+
+def respondent_demographics(panelist):
+    """The Response columns recording a panelist's buckets as they answer."""
+
+    return dict(
+        age_band=age_band(panelist.get_age()), gender_id=panelist.gender_id,
+        race_id=panelist.race_id, region_id=panelist.region_id)
+
+
+def question_tally_rows(survey_id, question_id, answer_ids, buckets):
+    """The zeroed rows of a new question, to insert into response_tallies."""
+
+    return [
+        dict(answer_id=answer_id, dimension=dimension, bucket=bucket,
+             question_id=question_id, survey_id=survey_id, tally=0)
+        for answer_id in answer_ids
+        for dimension, dimension_bucket_list in buckets.items()
+        for bucket in dimension_bucket_list]
+
+
+def create_question_tallies(survey_id, question_id, answer_ids, buckets=None):
+    """Adds the zeroed rows of a new question.  Does not commit."""
+
+    rows = question_tally_rows(survey_id, question_id, answer_ids, buckets or dimension_buckets())
+    # A question can be added with every answer left blank, and an empty
+    # executemany would still run the insert once.
+    if rows:
+        db.session.execute(ResponseTally.__table__.insert(), rows)
+
+
+def record_submission(panelist, answers):
+    """Counts a submission.  answers is a list of (question_id, answer_id).
+    Does not commit."""
+
+    table = ResponseTally.__table__
+    increment = table.update().where(and_(
+        table.c.answer_id == bindparam('a'),
+        table.c.dimension == bindparam('d'),
+        table.c.bucket == bindparam('b'),
+    )).values(tally=table.c.tally + 1)
+
+    buckets = panelist_buckets(panelist)
+    rows = [
+        dict(a=answer_id, d=dimension, b=bucket)
+        for question_id, answer_id in answers
+        for dimension, bucket in buckets]
+    # An empty executemany would run the update once with no parameters, eg.
+    # for a survey without questions.
+    if rows:
+        db.session.execute(increment, rows)
+
+
+def count_responses(survey_ids=None):
+    """Recounts the tallies from the responses table, by the demographics
+    recorded with each response.
+
+    Returns {(answer_id, dimension, bucket): (survey_id, question_id, tally)}
+    for every combination that has at least one response.
+    """
+
+    rows = db.session.query(
+        Response.parent_survey_id, Response.parent_question_id, Response.answer_id,
+        Response.gender_id, Response.race_id, Response.region_id, Response.age_band,
+        func.count(Response.response_id)
+    ).group_by(
+        Response.parent_survey_id, Response.parent_question_id, Response.answer_id,
+        Response.gender_id, Response.race_id, Response.region_id, Response.age_band)
+    if survey_ids is not None:
+        rows = rows.filter(Response.parent_survey_id.in_(survey_ids))
+
+    counts = {}
+    for survey_id, question_id, answer_id, gender_id, race_id, region_id, age, count in rows:
+        for dimension, bucket in (
+                (TOTAL, ''), ('Gender', name_of(GENDERS, gender_id)), ('Race', name_of(RACES, race_id)),
+                ('Region', name_of(REGIONS, region_id)), ('Age', age)):
+            key = (answer_id, dimension, bucket)
+            counts[key] = (survey_id, question_id, counts.get(key, (survey_id, question_id, 0))[2] + count)
+    return counts
+
+
+def rebuild(survey_ids=None):
+    """Replaces the tallies of some surveys, or all of them, with a fresh
+    count of their responses.  Does not commit.  Returns the number of rows
+    written."""
+
+    tallies = ResponseTally.query
+    if survey_ids is not None:
+        tallies = tallies.filter(ResponseTally.survey_id.in_(survey_ids))
+    tallies.delete(synchronize_session=False)
+
+    rows = dict(
+        (key, dict(answer_id=key[0], dimension=key[1], bucket=key[2],
+                   question_id=question_id, survey_id=survey_id, tally=count))
+        for key, (survey_id, question_id, count) in count_responses(survey_ids).items())
+
+    # Zeroed rows for every combination nobody has picked yet, so that
+    # submissions always find a row to add to.
+    buckets = dimension_buckets()
+    answers = db.session.query(Question.parent_survey_id, Question.question_id, Answer.answer_id).join(
+        Answer, Answer.parent_question_id == Question.question_id)
+    if survey_ids is not None:
+        answers = answers.filter(Question.parent_survey_id.in_(survey_ids))
+    for survey_id, question_id, answer_id in answers:
+        for dimension, dimension_bucket_list in buckets.items():
+            for bucket in dimension_bucket_list:
+                rows.setdefault((answer_id, dimension, bucket), dict(
+                    answer_id=answer_id, dimension=dimension, bucket=bucket,
+                    question_id=question_id, survey_id=survey_id, tally=0))
+
+    if rows:
+        db.session.execute(ResponseTally.__table__.insert(), list(rows.values()))
+    return len(rows)
+
+
+def check(survey_ids=None):
+    """Compares the tallies with a recount of the responses.  Returns a list
+    of (key, tally, recount) for every row that differs."""
+
+    expected = count_responses(survey_ids)
+    tallies = db.session.query(
+        ResponseTally.answer_id, ResponseTally.dimension, ResponseTally.bucket, ResponseTally.tally)
+    if survey_ids is not None:
+        tallies = tallies.filter(ResponseTally.survey_id.in_(survey_ids))
+
+    mismatches = []
+    for answer_id, dimension, bucket, tally in tallies:
+        key = (answer_id, dimension, bucket)
+        recount = expected.pop(key, (None, None, 0))[2]
+        if tally != recount:
+            mismatches.append((key, tally, recount))
+    mismatches.extend((key, 0, count) for key, (survey_id, question_id, count) in expected.items())
+    return mismatches
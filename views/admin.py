@@ -1,27 +1,150 @@
-from flask import Blueprint, render_template
+from collections import OrderedDict
+from flask import Blueprint, Response as HTTPResponse, abort, current_app, render_template, stream_with_context
+from sqlalchemy.orm import joinedload, selectinload
 from decorators import *
 from models import *
+from instrumentation import request_metrics
 
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
 
+# Rows per page of a paginated table.
+ADMIN_PAGE_SIZE = 50
+
+# Rows fetched from the DB at a time when streaming a whole table.
+ADMIN_STREAM_BATCH_SIZE = 500
+
+# table_name -> title, model, primary key and a function returning the loader
+# options that eager load everything the row macro in admin/rows.html touches
+# (a function since backrefs like Survey.publisher only exist once the
+# mappers are configured).  'collections' is True when those options load
+# one-to-many/many-to-many relationships, which can't be combined with a
+# server-side cursor, so those tables are streamed in keyset batches instead.
+ADMIN_TABLES = OrderedDict([
+    ('panelists', dict(title='Panelists', model=Panelist, key=Panelist.panelist_id, options=lambda: [], collections=False)),
+    ('surveys', dict(title='Surveys', model=Survey, key=Survey.survey_id, options=lambda: [
+        joinedload(Survey.publisher)], collections=False)),
+    ('races', dict(title='Races', model=Race, key=Race.race_id, options=lambda: [], collections=False)),
+    ('genders', dict(title='Genders', model=Gender, key=Gender.gender_id, options=lambda: [], collections=False)),
+    ('regions', dict(title='Regions', model=Region, key=Region.region_id, options=lambda: [], collections=False)),
+    ('questions', dict(title='Questions', model=Question, key=Question.question_id, options=lambda: [
+        selectinload(Question.answers)], collections=True)),
+    ('answers', dict(title='Answers', model=Answer, key=Answer.answer_id, options=lambda: [], collections=False)),
+    ('responses', dict(title='Responses', model=Response, key=Response.response_id, options=lambda: [
+        joinedload(Response.answer)], collections=False)),
+])
+
+
+def get_admin_table(table_name):
+    table = ADMIN_TABLES.get(table_name)
+    if table is None:
+        abort(404)
+    return table
+
+
+def admin_table_query(table):
+    return table['model'].query.options(*table['options']()).order_by(table['key'])
+
+
+def stream_table_rows(table):
+    """Yields every row of a table while holding at most one batch in memory.
+
+    Tables without eager loaded collections are read through a server-side
+    cursor (stream_results) in batches of ADMIN_STREAM_BATCH_SIZE.  The others
+    are read one keyset page at a time so their collections can still be
+    loaded with one extra query per batch.
+    """
+
+    if not table['collections']:
+        for row in admin_table_query(table).execution_options(
+                stream_results=True).yield_per(ADMIN_STREAM_BATCH_SIZE):
+            yield row
+        return
+
+    after_id = None
+    while True:
+        query = admin_table_query(table)
+        if after_id is not None:
+            query = query.filter(table['key'] > after_id)
+        rows = query.limit(ADMIN_STREAM_BATCH_SIZE).all()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        after_id = getattr(rows[-1], table['key'].key)
+        # The session only holds weak references to unmodified rows, so the
+        # batch is freed once rows is dropped.
+        rows = None
+
+
 @bp.route('/tables', methods=(['GET']))
 @login_required
+@read_only
 def admin():
-    """Endpoint for displaying tables for Panelists, Surveys,
-    and the Juntion tables for survey_races, survey_genders,
-    and survey_regions.
+    """Endpoint listing the tables that can be explored: Panelists, Surveys,
+    Races, Genders, Regions, Questions, Answers and Responses.
+    """
+
+    return render_template('admin/admintables.html', tables=ADMIN_TABLES)
+
+
+@bp.route('/tables/<string:table_name>', methods=(['GET']))
+@login_required
+@read_only
+def admin_table(table_name):
+    """Endpoint for one page of a table, ADMIN_PAGE_SIZE rows at a time.
+
+    Pages are keyset paginated on the primary key: the 'after' query argument
+    is the primary key of the last row on the previous page.  Relationships
+    shown in the table are eager loaded.
+    """
+
+    table = get_admin_table(table_name)
+    query = admin_table_query(table)
+
+    after_id = request.args.get('after', type=int)
+    if after_id is not None:
+        query = query.filter(table['key'] > after_id)
+
+    # Fetch one extra row to know whether there is a next page.
+    rows = query.limit(ADMIN_PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(rows) > ADMIN_PAGE_SIZE:
+        rows = rows[:ADMIN_PAGE_SIZE]
+        next_cursor = getattr(rows[-1], table['key'].key)
+
+    return render_template('admin/table.html',
+        table_name=table_name, title=table['title'], rows=rows, next_cursor=next_cursor, streaming=False)
+
+
+@bp.route('/tables/<string:table_name>/all', methods=(['GET']))
+@login_required
+@read_only
+def admin_table_stream(table_name):
+    """Endpoint that streams a whole table as one page.
+
+    The template is rendered as a generator over stream_table_rows, so the
+    first bytes go out straight away and neither the rows nor the HTML are
+    ever held in memory all at once.
     """
-    panelists = Panelist.query.all()
-    surveys = Survey.query.all()
-    genders = Gender.query.all()
-    races = Race.query.all()
-    regions = Region.query.all()
-    questions = Question.query.all()
-    answers = Answer.query.all()
-    responses = Response.query.all()
-
-    return render_template('admin/admintables.html', 
-        panelists=panelists, surveys=surveys, genders=genders, races=races,
-        regions=regions, questions=questions, answers=answers, responses=responses)
\ No newline at end of file
+
+    table = get_admin_table(table_name)
+
+    context = dict(
+        table_name=table_name, title=table['title'], rows=stream_table_rows(table),
+        next_cursor=None, streaming=True)
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template('admin/table.html')
+
+    return HTTPResponse(stream_with_context(template.generate(context)), mimetype='text/html')
+
+
+@bp.route('/metrics', methods=(['GET']))
+@admin_required
+def metrics():
+    """Endpoint exposing this worker's request latency, SQL time and query
+    count histograms per endpoint in the Prometheus text format.
+    """
+
+    return HTTPResponse(request_metrics.exposition(), mimetype='text/plain; version=0.0.4')
@@ -1,35 +1,121 @@
-from flask import Blueprint, flash, render_template
+from flask import Blueprint, abort, flash, render_template
 from flask_login import current_user
 from decorators import *
 from models import *
-from wtforms import Form, validators, RadioField, FieldList
-from flask_wtf import FlaskForm
+from eligibility import eligibility_index
+import conditional
+import identity
+import ledger
+import quota
+import routing
+import tallies
+from fragments import home_fragments
+from forms import get_survey_answering_form
+from sqlalchemy import and_, case, or_
 
 
 bp = Blueprint('answer', __name__, url_prefix='/answer')
 
 
+# Number of surveys shown per browse page.
+BROWSE_PAGE_SIZE = 12
+
+# sort_parameter -> (column to sort on, True if descending).  Ties are broken
+# by survey_id in the same direction, which is what makes the cursor unique.
+# Each is served by a composite (column, survey_id) index on surveys.
+BROWSE_SORTS = {
+    'shortest': (Survey.num_questions, False),
+    'longest': (Survey.num_questions, True),
+    'newest': (Survey.create_date, True),
+    'oldest': (Survey.create_date, False),
+}
+
+
+def parse_cursor(cursor):
+    """The 'after' cursor is the survey_id of the last survey on the previous
+    page.  Returns None if it is missing or not a number."""
+
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        return None
+
+
+def keyset_page(sort_column, descending, after_id, page_size):
+    """Returns one page of surveys in the given order, starting after the
+    survey with survey_id after_id, and the cursor for the next page (None on
+    the last page).
+
+    Rather than OFFSET, each page seeks straight past the (sort key,
+    survey_id) of the last survey on the previous page, so every page costs
+    the same no matter how deep into the catalogue it is.  The sort key is
+    looked up by primary key inside the query rather than carried in the
+    cursor, so it is always compared in the DB's own format.
+    """
+
+    query = Survey.query
+    if after_id is not None:
+        key = db.session.query(sort_column).filter(Survey.survey_id == after_id).as_scalar()
+        if descending:
+            query = query.filter(or_(
+                sort_column < key,
+                and_(sort_column == key, Survey.survey_id < after_id)))
+        else:
+            query = query.filter(or_(
+                sort_column > key,
+                and_(sort_column == key, Survey.survey_id > after_id)))
+
+    if descending:
+        query = query.order_by(sort_column.desc(), Survey.survey_id.desc())
+    else:
+        query = query.order_by(sort_column, Survey.survey_id)
+
+    # Fetch one extra row to know whether there is a next page.
+    surveys = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(surveys) > page_size:
+        surveys = surveys[:page_size]
+        next_cursor = surveys[-1].survey_id
+    return surveys, next_cursor
+
+
 @bp.route('/<string:sort_parameter>/', methods=(['GET', 'POST']))
 @login_required
+@read_only
 def browse(sort_parameter):
     """Endpoint for displaying surveys to browse and click on to begin taking.
 
     sort_parameter determines which query to use in displaying Surveys in the HTML page.
+    Surveys are shown BROWSE_PAGE_SIZE at a time.  The 'after' query argument
+    is the survey_id of the last survey on the previous page.
+
+    Answers a conditional GET with a 304 if no survey was created or
+    changed since the panelist last loaded the page, before loading any
+    surveys.
     """
 
+    after_id = parse_cursor(request.args.get('after'))
+
+    if sort_parameter != 'recommended' and sort_parameter not in BROWSE_SORTS:
+        abort(404)
+    etag = conditional.page_etag('browse', sort_parameter, after_id, conditional.surveys_version())
+    if conditional.is_fresh(etag):
+        return conditional.not_modified(etag)
+
     if sort_parameter == 'recommended':
-        surveys = current_user.get_eligible_surveys()
-    elif sort_parameter == 'shortest':
-        surveys = Survey.query.order_by(Survey.num_questions)
-    elif sort_parameter == 'longest':
-        surveys = Survey.query.order_by(Survey.num_questions.desc())
-    elif sort_parameter == 'newest':
-        surveys = Survey.query.order_by(Survey.create_date.desc())
-    elif sort_parameter == 'oldest':
-        surveys = Survey.query.order_by(Survey.create_date)
+        surveys = current_user.get_eligible_surveys(limit=BROWSE_PAGE_SIZE + 1, after_id=after_id)
+        next_cursor = None
+        if len(surveys) > BROWSE_PAGE_SIZE:
+            surveys = surveys[:BROWSE_PAGE_SIZE]
+            next_cursor = surveys[-1].survey_id
+    elif sort_parameter in BROWSE_SORTS:
+        sort_column, descending = BROWSE_SORTS[sort_parameter]
+        surveys, next_cursor = keyset_page(
+            sort_column, descending, after_id, BROWSE_PAGE_SIZE)
 
-            
-    return render_template('answer/browse.html', surveys=surveys)
+    return conditional.with_etag(
+        render_template('answer/browse.html', surveys=surveys, sort_parameter=sort_parameter, next_cursor=next_cursor),
+        etag)
 
 
 @bp.route('/<int:survey_id>', methods=(['GET', 'POST']))
@@ -38,97 +124,139 @@ def answer(survey_id):
     """Endpoint for answering a survey with a given survey_id.
 
     GET request:
-        1. Query to get the Survey object with given survey_id.
-        2. Define class for a form to be created dynamically within this view.
-           The contents are dependent entirely on the questions in the 
-           current survey and the answers to those questions.
-        3. For each question in the survey, create a RadioField with the
-           question text as the label and the answers to that question as the
-           choices, and assign as an attribute of the object. This is not the
-           best in terms of quality code but it works.
-        4. Return the template with the instantiated form object.
+        1. Query to get the Survey object with given survey_id.  Redirect back
+           to the recommended surveys if the panelist is not eligible for it.
+        2. Get the form class for the survey from forms.py.  It is created
+           dynamically with a RadioField per question, the question text as
+           the label and the answers to that question as the choices, and is
+           cached per survey.
+        3. Hold one of the survey's slots for the panelist with a quota lease.
+           Redirect back to the recommended surveys if it is full.
+        4. Return a 304 if the panelist already has this version of the
+           page, ie. the survey's questions and their CSRF token are the same.
+        5. Return the template with the instantiated form object.
 
     POST request:
-        1. Query to get the ID of the first question in the survey. To generate
-           rows in Response table for each question's response, we also need
-           the ID that corresponds to it.  Once we have the first one, we can 
-           increment by one since all questions are in numerical order.
-        2. Iterate over the attributes of the form to get the data for each
-           RadioField ie each response.  Create a new Response row with the
-           survey_id, the question_id, the panelist_id, and the response.
-           Increment the variable for the question_id so that the next added
-           response has the correct question_id.
-        3. Increment the panelist's point balance, and the survey's complete
-           count.
-        4. Return a redirect or some sort of screen saying thanks you earned
-           points...
+        0. Same eligibility check as the GET request.
+        1. Validate the form so that every question has one of its answers.
+           Record the panelist's completion, or redirect if they already
+           submitted it.  Confirm the panelist's quota lease, or redirect if
+           the survey filled up while they were answering.
+        2. Bulk insert one Response row per RadioField.  Each field is named
+           'q' + question_id, so the question id comes from the field name,
+           and its value is the answer_id picked.
+           Add the answers to the survey's ResponseTally rows.
+        3. Grant the survey's points through the ledger and increment the
+           survey's complete count with UPDATE ... SET x = x + n, closing it
+           in the same statement once it reaches its sample size.
+        4. Commit all of it as one transaction and redirect to home.
     """
 
     current_survey = Survey.query.get(survey_id)
 
-    # Define this form class in the view function per WTForms doc. The
-    # form fields have to be created dynamically or else they will not be 
-    # bound correctly to the form object.
-    class SurveyAnsweringForm(FlaskForm):
-        pass
-
-    # This loops through all the questions in the survey and creates an 
-    # attribute for each one and sets the value to a RadioField with a label
-    # representing the question text, and choices for each answer in that 
-    # question.  A list of all the attributes is kept in memory so that I can
-    # loop through all the RadioFields later on a POST request.
-    list_of_attributes = []
-    for question in current_survey.questions:
-        setattr(
-            SurveyAnsweringForm,
-            'q' + str(question.question_id),
-            RadioField(str(question.question), choices=[answer.answer for answer in question.answers])
-            )
-        list_of_attributes.append('q' + str(question.question_id))
-    
+    # Checked against the eligibility index on both GET and POST so that a
+    # closed, already answered or mistargeted survey can't be submitted.
+    if current_survey is None or not eligibility_index.is_eligible(current_user, survey_id):
+        flash('That survey is no longer available to you.')
+        return redirect(url_for('answer.browse', sort_parameter='recommended'))
+
+    if request.method == 'GET':
+        # Hold a slot for the panelist while they fill out the form.
+        if not quota.acquire(current_survey, current_user.panelist_id):
+            db.session.rollback()
+            flash('Sorry, that survey is full.')
+            return redirect(url_for('answer.browse', sort_parameter='recommended'))
+        db.session.commit()
+
+        etag = conditional.page_etag(
+            'answer', survey_id, current_survey.num_questions, current_survey.point_value,
+            conditional.csrf_validators())
+        if conditional.is_fresh(etag):
+            return conditional.not_modified(etag)
+
+    # The form class has one RadioField per question, named 'q' +
+    # question_id.  Building it means loading every question and answer, so
+    # the class is cached per survey and only rebuilt when a question is
+    # added.  The list of field names is used to loop through the RadioFields
+    # later on a POST request.
+    SurveyAnsweringForm, list_of_attributes = get_survey_answering_form(current_survey)
+
     form = SurveyAnsweringForm(request.form)
     
 
-    if request.method == 'POST':
-        # TODO: Check to see if the current user has already answered this 
-        # survey.
-        
-        # Use this to get the ID of the first question in the survey so that on
-        # each loop through the attributes, we can increment and have the 
-        # parent_question_id that each Response entry needs.
-        current_question_id = Question.query.filter_by(parent_survey_id=current_survey.survey_id).first().question_id
-        
-        # iterate through all the attributes of the form
-        for element in list_of_attributes:
-            # Add a response using the form label and data for each attribute.
-            db.session.add(
-                Response(
-                    parent_survey_id=current_survey.survey_id,
-                    parent_question_id=current_question_id,
-                    response_panelist_id=current_user.panelist_id,
-                    response=form[element].data
-                    )
-            )
-            current_question_id += 1
-        # Commit all of the responses in db session.
-        db.session.commit()
+    if request.method == 'POST' and form.validate():
+        # The completion's key stops a form submitted twice at once, which
+        # both passed the eligibility check, from counting twice.
+        if not quota.record_completion(current_survey, current_user.panelist_id):
+            db.session.rollback()
+            flash('You have already answered that survey.')
+            return redirect(url_for('answer.browse', sort_parameter='recommended'))
 
-        # Add the survey's point value to the panelist's balance
-        current_user.point_balance += current_survey.point_value
-        db.session.merge(current_user)
-        db.session.commit()
-        
-        # Increment the number of responses to that survey by 1 and
-        # if that number is equal to the sample size, set the status to
-        # 'Completed'.
-        current_survey.completes += 1
-        if current_survey.completes >= current_survey.sample_size:
-            current_survey.status = 'Completed'
-        db.session.merge(current_survey)
+        # The lease taken when the form was served becomes a complete.  This
+        # is what keeps the survey from collecting more than its sample size.
+        if not quota.confirm(current_survey, current_user.panelist_id):
+            db.session.rollback()
+            flash('Sorry, that survey filled up before you submitted it.')
+            return redirect(url_for('answer.browse', sort_parameter='recommended'))
+
+        # Insert all of the responses in one executemany.  The attributes are
+        # named 'q' + question_id so the real question ids come from them, and
+        # their data is the answer_id picked.
+        # Each response also records the panelist's demographics as of now.
+        answers = [(int(element[1:]), form[element].data) for element in list_of_attributes]
+        demographics = tallies.respondent_demographics(current_user)
+        db.session.bulk_insert_mappings(Response, [
+            dict(
+                parent_survey_id=current_survey.survey_id,
+                parent_question_id=question_id,
+                response_panelist_id=current_user.panelist_id,
+                answer_id=answer_id,
+                **demographics
+                )
+            for question_id, answer_id in answers])
+
+        # Count the answers in the survey's results tallies.
+        tallies.record_submission(current_user, answers)
+
+        # Add the survey's point value to the panelist's balance through the
+        # points ledger.
+        ledger.grant(
+            current_user.panelist_id, current_survey.point_value,
+            'Completed survey ' + str(current_survey.survey_id))
+
+        # Increment the number of responses to that survey by 1 and if that
+        # reaches the sample size, set the status to 'Completed'.  Both sides
+        # of the SET see the row as it was before the UPDATE.  The quota means
+        # only the submission confirming the last slot gets to close it.
+        Survey.query.filter_by(survey_id=current_survey.survey_id).update(
+            {
+                Survey.completes: Survey.completes + 1,
+                Survey.status: case(
+                    [(Survey.completes + 1 >= Survey.sample_size, 'Completed')],
+                    else_=Survey.status)
+            },
+            synchronize_session=False)
+
+        # Responses, tallies, balance and completes are committed together.
         db.session.commit()
+        routing.record_write()
+
+        identity.invalidate(current_user.panelist_id)
+        home_fragments.bump_user(current_user.panelist_id)
+
+        # The commit expired current_survey so this reads the new status.
+        if current_survey.status == 'Completed':
+            eligibility_index.remove_survey(current_survey.survey_id)
+            home_fragments.bump_global()
+            # It drops out of the recommended lists.  Bumped apart from the
+            # submission, which would otherwise queue on the version row.
+            conditional.bump_surveys_version()
+            db.session.commit()
         
         # Redirect to home page.
         return redirect(url_for('other_views.home'))
 
-
-    return render_template('answer/answer.html', current_survey=current_survey, form=form, list_of_attributes=list_of_attributes)
\ No newline at end of file
+    page = render_template('answer/answer.html', current_survey=current_survey, form=form, list_of_attributes=list_of_attributes)
+    if request.method == 'GET':
+        return conditional.with_etag(page, etag)
+    return page
\ No newline at end of file
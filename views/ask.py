@@ -1,8 +1,15 @@
-from flask import Blueprint, flash, g, redirect, render_template, request, session, url_for
+from flask import Blueprint, flash, g, jsonify, redirect, render_template, request, session, url_for
 from flask_login import current_user
 from decorators import *
-from forms import MultiCheckboxField, SurveyDetailsForm, SurveyContentForm
+from forms import MultiCheckboxField, SurveyDetailsForm, SurveyContentForm, invalidate_survey_answering_form
 from models import *
+from eligibility import eligibility_index
+from fragments import home_fragments
+import conditional
+import quota
+import routing
+import survey_import
+import tallies
 
 
 bp = Blueprint('ask', __name__, url_prefix='/ask')
@@ -18,14 +25,15 @@ def create_index():
     
     On POST request:
         1. Validate form fields and use them to create the new Survey object.
-        2. Loop through the race/gender/region ids in their form field. Append
-           the corresponding Race/Gender/Region objects to the .races/.genders/
-           .regions attributes of the new Survey object.
-        3. Add the new Survey object to session and commit.
-        4. Redirect to the create_survey template given the new Surveys id.
-
-    FOR THIS TO WORK, RACE/GENDER/REGION tables must be populated according to
-    the Google Spreadsheet schema tab.
+        2. Turn the race/gender/region ids in their form fields into the
+           targeting bitmasks of the new Survey object.
+        3. Add the new Survey object and its quota of sample_size open slots
+           to session and commit.
+        4. Add the new Survey to the eligibility index.
+        5. Redirect to the create_survey template given the new Surveys id.
+
+    FOR THIS TO WORK, the race/gender/region ids of SurveyDetailsForm must
+    match the RACES/GENDERS/REGIONS lists in models.py.
     """
     
     form = SurveyDetailsForm(request.form)
@@ -39,32 +47,57 @@ def create_index():
             sample_size=form.sample_size.data,
             min_age=form.min_age.data,
             max_age=form.max_age.data,
+            # The race, gender and region form fields allow for multiple
+            # selections of ids, which are stored as one bitmask each.
+            race_mask=mask_of(form.race.data),
+            gender_mask=mask_of(form.gender.data),
+            region_mask=mask_of(form.region.data),
             )
 
-        # Because the race, gender, and region form fields allow for multiple
-        # selections, we have to loop through them and add the Race/Gender/
-        # Region objects to the related attribute of the survey.  Survey and
-        # Race/Gender/Region is a many-to-many relationship, so we append the
-        # Race/Gender/Region objects that correspond to the provided form data.
-        for race_id_provided in form.race.data:
-            survey_to_add.races.append(Race.query.filter_by(race_id=race_id_provided).first())
-
-        for gender_id_provided in form.gender.data:
-            survey_to_add.genders.append(Gender.query.filter_by(gender_id=gender_id_provided).first())
-
-        for region_id_provided in form.region.data:
-            survey_to_add.regions.append(Region.query.filter_by(region_id=region_id_provided).first())
-        
         # Add to session and get the survey_id to to redirect to.
         db.session.add(survey_to_add)
+        quota.create_quota(survey_to_add)
+        conditional.bump_surveys_version()
         survey_id = survey_to_add.survey_id
         db.session.commit()
+        routing.record_write()
+
+        # Make the new survey recommendable right away in this worker.
+        eligibility_index.add_survey(survey_to_add)
+        home_fragments.bump_user(current_user.panelist_id)
+        home_fragments.bump_global()
         
         return redirect(url_for('ask.create_survey', survey_id=survey_id))
 
     return render_template('ask/create_index.html', form=form)
 
 
+@bp.route('/import', methods=(['POST']))
+@login_required
+def import_surveys():
+    """Endpoint for creating many surveys, questions and answers included, in
+    one request.
+
+    Takes a JSON body of survey definitions as described in survey_import.py,
+    checks all of them with the same forms as the Ask pages and creates them
+    all at once, or none of them if any is invalid.
+
+    Only JSON bodies are accepted.  Browsers can't send one cross-site without
+    CORS, so this needs no CSRF token.
+
+    Returns {"survey_ids": [...]} with status 201, or {"errors": [...]} with
+    status 400.
+    """
+
+    if not request.is_json:
+        return jsonify(errors=[{'survey': None, 'field': None, 'messages': ['Expected a JSON body.']}]), 400
+    try:
+        survey_ids = survey_import.import_surveys(request.get_json(), current_user.panelist_id)
+    except survey_import.SurveyImportError as error:
+        return jsonify(errors=error.errors), 400
+    return jsonify(survey_ids=survey_ids), 201
+
+
 @bp.route('/<int:survey_id>', methods=(['GET', 'POST']))
 @login_required
 def create_survey(survey_id):
@@ -79,7 +112,8 @@ def create_survey(survey_id):
         2. Create new Question object with form.question_text.data.
         3. For each answer_text in form.answer_text.data, create a new Answer
            object and append it to Question.answers.
-        4. Append the Question object to current_survey.questions.
+        4. Append the Question object to current_survey.questions and create
+           its result tallies.
         5. Add the new Question object and the existing, updated
            current_survey.questions object to session and commit.
         6. Redirect to the same page, but reload with updated Survey object.
@@ -116,16 +150,28 @@ def create_survey(survey_id):
                 new_question.answers.append(answer_to_add)
         
         db.session.flush() # Code does not work without this flush. Look into.
-        db.session.commit()
+
+        # Zeroed result tallies for each answer, for submissions to add to.
+        tallies.create_question_tallies(
+            current_survey.survey_id, new_question.question_id,
+            [answer.answer_id for answer in new_question.answers])
 
         # Each time a question is added, increment survey's num_question
         # attribute by 1 and point_value by 5.  Every question is 5 points.
         current_survey.num_questions += 1
         current_survey.point_value += 5
 
-        # Push these changes to the survey object to the DB.
+        # Push these changes to the survey object to the DB, in the same
+        # transaction as the question and its tallies.
         db.session.merge(current_survey)
+        conditional.bump_surveys_version()
         db.session.commit()
+        routing.record_write()
+
+        # The cached answering form of this survey is now missing a question,
+        # and the survey cards on home show the old length and points.
+        invalidate_survey_answering_form(survey_id)
+        home_fragments.bump_global()
 
         # Redirect to the same page so that it can show with the new question.
         return redirect(url_for('ask.create_survey', survey_id=survey_id))
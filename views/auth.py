@@ -4,6 +4,9 @@ from flask_login import current_user, login_user, logout_user
 from forms import RegistrationForm, PanelistDetailsForm, PanelistLoginForm
 from models import Panelist
 from __init__ import db
+import identity
+import routing
+from fragments import home_fragments
 
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
@@ -46,6 +49,7 @@ def register():
             user_to_register = Panelist(email=email, password=generate_password_hash(password))
             db.session.add(user_to_register)
             db.session.commit()
+            routing.record_write()
 
             # This part is sketchy. Store email in session so that it can
             # be accessed to run a query in the next page.
@@ -102,6 +106,9 @@ def details():
         # Need to merge so that the attribute values are written to the DB.
         db.session.merge(panelist_to_update)
         db.session.commit()
+        routing.record_write()
+        identity.invalidate(panelist_to_update.panelist_id)
+        home_fragments.bump_user(panelist_to_update.panelist_id)
 
         # Query to get the same panelist object and pass it into Flask-Login's
         # login_user function to log that user in.
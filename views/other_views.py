@@ -1,14 +1,23 @@
 import functools
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for, send_file
+    Blueprint, Response as HTTPResponse, abort, flash, g, jsonify, redirect, render_template, request, session,
+    stream_with_context, url_for, send_file
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 from flask_login import current_user, login_user
 from decorators import *
 from models import *
 from __init__ import db
-import xlsxwriter
-from io import BytesIO
+from sqlalchemy import or_
+import conditional
+import export_jobs
+import exports
+import identity
+import ledger
+import routing
+import snapshots
+from fragments import home_fragments
+from results import survey_results
 
 
 bp = Blueprint('other_views', __name__)
@@ -17,75 +26,203 @@ bp = Blueprint('other_views', __name__)
 @bp.route('/home/', methods=(['GET', 'POST']))
 @login_required
 def home():
-    home_surveys = current_user.get_eligible_surveys()
-    challenges = Challenge.query.limit(2)
-    
-    num_completed = Response.query.filter_by(response_panelist_id=current_user.panelist_id).count() # count the number of unique survey_ids in that panelists responses table.
-    num_published = Survey.query.filter_by(publisher_id=current_user.panelist_id).count()
-    featured_surveys = Survey.query.filter_by(status='Completed').limit(3)
-    my_surveys = Survey.query.filter_by(publisher_id=current_user.panelist_id).all()
+    """The user dashboard.
+
+    Each section (challenges and their counters, featured surveys and
+    recommended surveys) is a fragment cached per panelist by
+    fragments.home_fragments.  A section's queries only run when it has to be
+    re-rendered, ie. after that panelist submits, publishes or redeems or
+    after a survey opens or closes.
+    """
+    panelist_id = current_user.panelist_id
+
+    def render_challenges():
+        challenges = Challenge.query.limit(2).all()
+        num_completed = Response.query.filter_by(response_panelist_id=panelist_id).count() # count the number of unique survey_ids in that panelists responses table.
+        num_published = Survey.query.filter_by(publisher_id=panelist_id).count()
+        return render_template('views/home_challenges.html', challenges=challenges, num_completed=num_completed, num_published=num_published)
+
+    def render_featured():
+        featured_surveys = Survey.query.filter_by(status='Completed').limit(3)
+        return render_template('views/home_featured.html', featured_surveys=featured_surveys)
 
-    return render_template('views/home.html', home_surveys = home_surveys, num_completed=num_completed, num_published=num_published, challenges=challenges, featured_surveys=featured_surveys)
+    def render_recommended():
+        home_surveys = current_user.get_eligible_surveys()
+        return render_template('views/home_recommended.html', home_surveys=home_surveys)
+
+    return render_template('views/home.html',
+        challenges_html=home_fragments.get_or_render(panelist_id, 'challenges', render_challenges),
+        featured_html=home_fragments.get_or_render(panelist_id, 'featured', render_featured),
+        recommended_html=home_fragments.get_or_render(panelist_id, 'recommended', render_recommended))
 
 
 @bp.route('/challenge/<int:challenge_id>', methods=(['GET', 'POST']))
 @login_required
 def challenge_redemption(challenge_id):
-    redeemed = getattr(current_user,'redeemed_challenge_' + str(challenge_id))
+    """Claim the award of a challenge once.
+
+    The redeemed_challenge_ flag is flipped with a conditional UPDATE so a
+    double click can't claim the award twice, and the award is granted
+    through the points ledger in the same transaction.
+    """
+    redeemed_column = getattr(Panelist, 'redeemed_challenge_' + str(challenge_id))
+
+    claimed = Panelist.query.filter(
+        Panelist.panelist_id == current_user.panelist_id,
+        or_(redeemed_column == False, redeemed_column.is_(None))
+    ).update({redeemed_column: True}, synchronize_session=False)
 
-    if redeemed:
-        pass
-    else:
-        setattr(current_user,'redeemed_challenge_' + str(challenge_id), True)
-        current_user.point_balance += Challenge.query.get(challenge_id).award
-        db.session.merge(current_user)
-        db.session.commit()
-        return redirect(url_for('other_views.home'))
+    if claimed:
+        ledger.grant(
+            current_user.panelist_id, Challenge.query.get(challenge_id).award,
+            'Challenge ' + str(challenge_id))
+    db.session.commit()
+    routing.record_write()
+    identity.invalidate(current_user.panelist_id)
+    home_fragments.bump_user(current_user.panelist_id)
+
+    return redirect(url_for('other_views.home'))
 
 
 @bp.route('/export/<int:survey_id>', methods=(['GET', 'POST']))
 @login_required
+@read_only
 def export_to_excel(survey_id):
-    current_survey = Survey.query.get(survey_id)
-    """Display the data in such a way to lend itself to being able to pivot to see the breakdown of responses by question.
+    """Download the responses of a survey as an Excel workbook.
+
+    Workbooks are built in the background by export_jobs and cached on disk
+    per survey and number of completes.  If the survey's current workbook is
+    cached it is sent straight away, otherwise its build is queued and the
+    panelist is sent to export_status to wait for it.
+
+    Display the data in such a way to lend itself to being able to pivot to see the breakdown of responses by question.
     Plan out using Excel on pc and see what works.  Also if XlsxWriter is easy enough, maybe make it generate the pivot table
     by default."""
-    current_survey = Survey.query.get(survey_id)
+    current_survey = Survey.query.get_or_404(survey_id)
+
+    path = export_jobs.request_export(current_survey)
+    if path is None:
+        return redirect(url_for('other_views.export_status', survey_id=survey_id))
+
+    # conditional answers If-None-Match/If-Modified-Since with a 304.  The
+    # cached file is only replaced once the survey has a new complete.
+    response = send_file(
+        filename_or_fp=path,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        attachment_filename=str(current_survey.title) + '.xlsx',
+        as_attachment=True,
+        conditional=True)
+    response.headers['Cache-Control'] = conditional.CACHE_CONTROL
+    return response
+
 
-    output = BytesIO()
-    workbook = xlsxwriter.Workbook(output)
+@bp.route('/export/bulk', methods=(['GET']))
+@login_required
+@read_only
+def export_bulk():
+    """Download the responses of several of the panelist's surveys at once,
+    as a ZIP archive with one workbook per survey and a Summary.xlsx of how
+    many responses each answer got.
+
+    The 'survey' query argument picks the surveys, eg.
+    '/export/bulk?survey=3&survey=7'.  Without it every survey the panelist
+    published is included.  Only the panelist's own surveys can be picked.
 
-    worksheet = workbook.add_worksheet()
-    col_names = ['Question', 'Response', 'Age', 'Gender', 'Race', 'Region']
-    col_counter = 0
-    for name in col_names:
-        worksheet.write(0, col_counter, name)
-        col_counter += 1
+    The archive is streamed while the workbooks are built, one survey at a
+    time, so the download starts straight away and memory use stays flat.
+    """
 
-    row_counter = 1
-    for row in current_survey.responses:
-        worksheet.write(row_counter, 0, row.parent_question.question)
-        worksheet.write(row_counter, 1, row.response)
-        worksheet.write(row_counter, 2, row.response_panelist.get_age())
-        worksheet.write(row_counter, 3, row.response_panelist.gender)
-        worksheet.write(row_counter, 4, row.response_panelist.race)
-        worksheet.write(row_counter, 5, row.response_panelist.region)
-        row_counter += 1
+    own_survey_ids = [survey_id for survey_id, in db.session.query(Survey.survey_id).filter(
+        Survey.publisher_id == current_user.panelist_id)]
+    survey_ids = request.args.getlist('survey', type=int) or own_survey_ids
+    if not set(survey_ids) <= set(own_survey_ids):
+        abort(404)
 
-    workbook.close()
-    output.seek(0)
+    response = HTTPResponse(
+        stream_with_context(exports.stream_surveys_archive(survey_ids)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename=surveys.zip'
+    return response
 
-    return send_file(filename_or_fp=output, attachment_filename=str(current_survey.title) + '.xlsx', as_attachment=True)
+
+@bp.route('/export/<int:survey_id>/status', methods=(['GET']))
+@login_required
+@read_only
+def export_status(survey_id):
+    """Page shown while a survey's workbook is being built.  It refreshes
+    itself until the workbook is ready and then redirects to the download."""
+    current_survey = Survey.query.get_or_404(survey_id)
+
+    if export_jobs.request_export(current_survey) is not None:
+        return redirect(url_for('other_views.export_to_excel', survey_id=survey_id))
+
+    return render_template('views/export_status.html', current_survey=current_survey)
 
 
 @bp.route('/results/<int:survey_id>', methods=(['GET', 'POST']))
 @login_required
+@read_only
 def see_results(survey_id):
-    """See the relevent Response object for that survey"""
+    """See the results of a survey summarized per question.
+
+    The counts and percentages for each answer, overall and broken down by
+    gender, race, region and age band, come from the survey's ResponseTally
+    rows in results.survey_results instead of rendering every Response row.
 
-    current_survey = Survey.query.get(survey_id)
+    Answers a conditional GET with a 304 before computing any of that if
+    the survey had no new completes since the panelist last loaded it.
+    """
 
-    return render_template('views/results.html', current_survey=current_survey)
+    current_survey = Survey.query.get_or_404(survey_id)
+
+    # Every submission adds a complete along with its tallies, so the page
+    # only changes with completes or questions.
+    etag = conditional.page_etag('results', survey_id, current_survey.completes, current_survey.num_questions, current_survey.status)
+    if conditional.is_fresh(etag):
+        return conditional.not_modified(etag)
+
+    results = survey_results(current_survey)
+
+    return conditional.with_etag(
+        render_template('views/results.html', current_survey=current_survey, results=results),
+        etag)
+
+
+@bp.route('/results/<int:survey_id>/crosstab', methods=(['GET']))
+@login_required
+@read_only
+def crosstab(survey_id):
+    """Counts of a survey's answers broken down by any combination of age
+    band, gender, race and region, as JSON.
+
+    Query arguments:
+    question: a question_id to count the answers of.  All questions if left
+        out.
+    by: comma separated dimensions to break the counts down by, eg.
+        'gender,age'.
+    age/gender/race/region: only count panelists with one of these labels,
+        eg. '?gender=Female&age=18-24&age=25-34'.
+
+    Counted from the survey's memory-mapped snapshot (see snapshots.py), so
+    it does not query the responses.  Returns {"completes": the completes
+    the snapshot was built at, "cells": [...]}, or {"error": ...} with
+    status 400.
+    """
+
+    current_survey = Survey.query.get_or_404(survey_id)
+
+    question_id = request.args.get('question', type=int)
+    by = [dimension for dimension in request.args.get('by', '').split(',') if dimension]
+    filters = dict(
+        (dimension, request.args.getlist(dimension))
+        for dimension in snapshots.DIMENSIONS if dimension in request.args)
+
+    snapshot = snapshots.get_snapshot(current_survey)
+    try:
+        cells = snapshot.crosstab(question_id, by, filters)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+
+    return jsonify(completes=snapshot.completes, cells=cells)
 
 
 @bp.route('/', methods=(['GET', 'POST']))
@@ -100,9 +237,14 @@ def index():
 
 @bp.route('/profile/', methods=(['GET', 'POST']))
 @login_required
+@read_only
 def profile():
     #surveys_ive_responded_to = Response.query.filter_by(response_panelist_id=current_user.panelist_id).distinct(Response.parent_survey_id).group_by(Response.parent_survey_id).all() # count the number of unique survey_ids in that panelists responses table.
-    surveys_ive_responded_to = Survey.query.filter(Survey.responses.any(Response.response_panelist_id == current_user.panelist_id))
+    # IN over the panelist's responses rather than EXISTS per survey, so that
+    # this is an index lookup instead of a scan of every survey.
+    surveys_ive_responded_to = Survey.query.filter(Survey.survey_id.in_(
+        db.session.query(Response.parent_survey_id).filter(Response.response_panelist_id == current_user.panelist_id)
+        ))
     my_redemptions = Redemption.query.filter_by(redemption_panelist_id=current_user.panelist_id)
     
     return render_template('views/profile.html', surveys_ive_responded_to=surveys_ive_responded_to, my_redemptions=my_redemptions)
\ No newline at end of file
@@ -1,8 +1,12 @@
-from flask import Blueprint, flash, g, redirect, render_template, request, session, url_for
+from flask import Blueprint, flash, g, redirect, render_template, request, session
 from flask_login import current_user
 from decorators import *
 from forms import IncentiveRedemption
 from models import *
+import identity
+import ledger
+import routing
+from fragments import home_fragments
 
 
 bp = Blueprint('redeem', __name__, url_prefix='/redeem')
@@ -15,78 +19,61 @@ def redeem():
     return render_template('redeem/redeem.html')
 
 
-@bp.route('/amazon/', methods=['GET', 'POST'])
-@login_required
-def amazon():
+def redeem_points(redemption, template):
+    """Shared body of the Amazon, PayPal and Venmo redemption views.
+
+    On GET request:
+        Display the template with the IncentiveRedemption form.
+
+    On POST request:
+        1. Validate the form, so only one of the offered amounts can be
+           redeemed.  Otherwise flash an error.
+        2. Debit the chosen amount through the points ledger.  The debit is a
+           single conditional UPDATE that only succeeds if the panelist has
+           enough points.
+        3. If it succeeded, add the Redemption row and commit both together.
+           Otherwise flash an error.
+        4. Redirect back to the same page.
+    """
     form = IncentiveRedemption(request.form)
 
     if request.method == 'POST':
         redemption_amount = form.amount.data
-        
-        if redemption_amount <= current_user.point_balance:
+
+        if not form.validate():
+            flash('Please choose one of the amounts.')
+        elif ledger.debit(current_user.panelist_id, redemption_amount, 'Redeemed for ' + redemption):
             db.session.add(
                 Redemption(
-                    redemption='Amazon',
+                    redemption=redemption,
                     amount=redemption_amount,
                     redemption_panelist_id=current_user.panelist_id
                     )
                 )
-            current_user.point_balance -= redemption_amount
-            db.session.merge(current_user)
             db.session.commit()
+            routing.record_write()
+            identity.invalidate(current_user.panelist_id)
+            home_fragments.bump_user(current_user.panelist_id)
         else:
-            pass
-        return redirect(url_for('redeem.amazon'))
+            flash('You do not have enough points for that reward.')
+        return redirect(request.path)
+
+    return render_template(template, form=form)
 
 
-    return render_template('redeem/amazon.html', form=form)
+@bp.route('/amazon/', methods=['GET', 'POST'])
+@login_required
+def amazon():
+    return redeem_points('Amazon', 'redeem/amazon.html')
 
 
 @bp.route('/paypal/', methods=['GET', 'POST'])
 @login_required
 def paypal():
-    form = IncentiveRedemption(request.form)
-
-    if request.method == 'POST':
-        redemption_amount = form.amount.data
-        
-        if redemption_amount <= current_user.point_balance:
-            db.session.add(
-                Redemption(
-                    redemption='PayPal',
-                    amount=redemption_amount,
-                    redemption_panelist_id=current_user.panelist_id
-                    )
-                )
-            current_user.point_balance -= redemption_amount
-            db.session.merge(current_user)
-            db.session.commit()
-        else:
-            pass
-
-    return render_template('redeem/paypal.html', form=form)
+    return redeem_points('PayPal', 'redeem/paypal.html')
 
 
 @bp.route('/venmo/', methods=['GET', 'POST'])
 @login_required
 def venmo():
-    form = IncentiveRedemption(request.form)
-
-    if request.method == 'POST':
-        redemption_amount = form.amount.data
-        
-        if redemption_amount <= current_user.point_balance:
-            db.session.add(
-                Redemption(
-                    redemption='Venmo',
-                    amount=redemption_amount,
-                    redemption_panelist_id=current_user.panelist_id
-                    )
-                )
-            current_user.point_balance -= redemption_amount
-            db.session.merge(current_user)
-            db.session.commit()
-        else:
-            pass
-
-    return render_template('redeem/venmo.html', form=form)
\ No newline at end of file
+    return redeem_points('Venmo', 'redeem/venmo.html')
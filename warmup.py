@@ -0,0 +1,93 @@
+"""Warm start for create_app, for gunicorn --preload.
+
+Without it a fresh worker configures the mappers on its first query,
+compiles each template the first time it renders it and loads the
+eligibility index on the first home/browse hit, so the first requests after
+a (re)start are slow.  With WARM_START=1 create_app does all of that up
+front, in the gunicorn master when it preloads the app, and the workers
+forked from it start with everything in memory:
+
+    mappers: configures every mapper and relationship.
+    templates: compiles every template, also into a Jinja bytecode cache in
+        JINJA_CACHE_DIR so that a restart only has to load them from disk.
+    reference data: loads the reference table lookups and the eligibility
+        index.
+
+The DB connections opened along the way are closed afterwards, since
+connections must not be shared by the processes forked from the master.
+
+create_app times each phase of startup with a StartupTimer.  The timings are
+logged, and exposed by /admin/metrics as amplify_startup_phase_seconds.
+"""
+import logging
+import os
+import time
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import orm
+
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimer(object):
+    """Times consecutive phases of startup.  Each call to mark() ends the
+    current phase."""
+
+    def __init__(self):
+        self.phases = []  # (phase, seconds)
+        self._started_at = self._phase_started_at = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._phase_started_at))
+        self._phase_started_at = now
+
+    def total(self):
+        return time.perf_counter() - self._started_at
+
+    def report(self):
+        logger.info(
+            'App started in %.1f ms (%s).', self.total() * 1000,
+            ', '.join('%s %.1f ms' % (phase, seconds * 1000) for phase, seconds in self.phases))
+
+
+def precompile_templates(app):
+    """Compiles every template of the app and its blueprints.  Returns the
+    number compiled."""
+
+    os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def warm_reference_data(app):
+    from __init__ import db
+    from eligibility import eligibility_index
+    import tallies
+    with app.app_context():
+        try:
+            tallies.dimension_buckets()
+            eligibility_index.rebuild()
+        except Exception as error:
+            # Eg. the tables don't exist yet.  The first requests load them.
+            logger.warning('Unable to warm the reference data: %s', error)
+        # Don't hand the connections of the master to the workers.
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(app, bind=bind).dispose()
+
+
+def warm(app, timer):
+    """Does the work a worker would otherwise do on its first requests."""
+
+    orm.configure_mappers()
+    timer.mark('mappers')
+
+    compiled = precompile_templates(app)
+    timer.mark('templates')
+    logger.debug('%d templates compiled.', compiled)
+
+    warm_reference_data(app)
+    timer.mark('reference data')